@@ -0,0 +1,130 @@
+"""
+Async variants of the auth endpoints, served by the ASGI application.
+
+authenticate() and create_user(), which hash passwords, run on a bounded
+HashingPool and the token queries use the async ORM, so the event loop keeps
+serving other requests during a login storm. The pool's threads close their
+database connections after each call rather than keeping one per thread.
+"""
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connections
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework.authtoken.models import Token
+
+from .hashing import HashingPool, PoolSaturated
+
+hashing_pool = HashingPool.from_settings(getattr(settings, "PASSWORD_HASHING_POOL", {}))
+
+
+def async_post(view):
+    @wraps(view)
+    async def wrapper(request):
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+        return await view(request)
+
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def closing_connections(func):
+    @wraps(func)
+    def call(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()
+
+    return call
+
+
+def read_credentials(request):
+    try:
+        if request.content_type == "application/json":
+            data = json.loads(request.body)
+        else:
+            data = request.POST
+        username, password = data["username"], data["password"]
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(username, str) or not isinstance(password, str):
+        return None
+    return username, password
+
+
+def busy_response():
+    response = JsonResponse(
+        {"error": "Too many concurrent logins. Please retry later"}, status=503
+    )
+    response["Retry-After"] = str(hashing_pool.retry_after)
+    return response
+
+
+@async_post
+async def signup(request):
+    credentials = read_credentials(request)
+    if credentials is None:
+        return JsonResponse(
+            {"error": "Could not signup. Please check username and password"},
+            status=400,
+        )
+    username, password = credentials
+
+    try:
+        user = await hashing_pool.run(
+            closing_connections(User.objects.create_user), username, password=password
+        )
+    except PoolSaturated:
+        return busy_response()
+    except ValueError:
+        return JsonResponse(
+            {"error": "Could not signup. Please check username and password"},
+            status=400,
+        )
+    except IntegrityError:
+        return JsonResponse(
+            {
+                "error": "That username has already been taken. Please choose a new username"
+            },
+            status=403,
+        )
+
+    token = await Token.objects.acreate(user=user)
+
+    return JsonResponse({"token": str(token)}, status=201)
+
+
+@async_post
+async def login(request):
+    credentials = read_credentials(request)
+    if credentials is None:
+        return JsonResponse(
+            {"error": "Could not login. Please check username and password"},
+            status=400,
+        )
+    username, password = credentials
+
+    try:
+        user = await hashing_pool.run(
+            closing_connections(authenticate),
+            request,
+            username=username,
+            password=password,
+        )
+    except PoolSaturated:
+        return busy_response()
+
+    if user is None:
+        return JsonResponse(
+            {"error": "Could not login. Please check username and password"},
+            status=404,
+        )
+
+    token, _ = await Token.objects.aget_or_create(user=user)
+
+    return JsonResponse({"token": str(token)}, status=200)
@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import router
+from rest_framework.authentication import TokenAuthentication
+
+# The user fields kept in the cache, which the permission checks read. The
+# others, such as the password hash, are deferred: loaded from the database if
+# a view reads them. Model.from_db() takes them in the model's order.
+CACHED_USER_FIELDS = tuple(
+    field.attname
+    for field in User._meta.concrete_fields
+    if field.name in ("id", "username", "is_active", "is_staff", "is_superuser")
+)
+
+
+def token_cache_key(key):
+    return f"auth:token-user:{key}"
+
+
+def token_cache():
+    return caches[getattr(settings, "AUTH_TOKEN_CACHE_ALIAS", "default")]
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that keeps the token -> user lookup in a cache, as the
+    values of CACHED_USER_FIELDS.
+
+    Entries are dropped as soon as the token is deleted or its user is saved
+    (e.g. deactivated), see signals.py, which only reaches every process when
+    the cache is shared by them. Changes that skip the signals, such as
+    QuerySet.update(), are seen once the entry expires, so the alias' TIMEOUT
+    is kept to seconds.
+    """
+
+    def authenticate_credentials(self, key):
+        cache = token_cache()
+        cache_key = token_cache_key(key)
+
+        values = cache.get(cache_key)
+        if values is None:
+            user, token = super().authenticate_credentials(key)
+            cache.set(cache_key, [getattr(user, name) for name in CACHED_USER_FIELDS])
+            return user, token
+
+        db = router.db_for_read(User)
+        user = User.from_db(db, CACHED_USER_FIELDS, values)
+        token = self.get_model().from_db(db, ["key", "user_id"], [key, user.pk])
+        token.user = user
+        return user, token
@@ -0,0 +1,193 @@
+"""
+Benchmarks for the owner endpoints.
+
+Not collected by the default test run; execute explicitly with
+
+    python manage.py test app_restaurants.benchmarks
+"""
+import asyncio
+from time import perf_counter
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import metrics
+from .metrics import RequestMetricsMiddleware
+from .models import Restaurant, Ticket
+from .views import RestaurantTicketViewSet, RestaurantViewSet
+
+REQUESTS = 500
+
+
+class TokenAuthenticationBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        cls.token = Token.objects.create(user=user)
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.bulk_create(Ticket(restaurant=restaurant) for _ in range(10))
+
+    def requests_per_second(self, endpoint):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        start = perf_counter()
+        for _ in range(REQUESTS):
+            client.get(endpoint)
+        return REQUESTS / (perf_counter() - start)
+
+    def test_requests_per_second(self):
+        print()
+        for endpoint in ("/restaurants/", "/restaurants/1/tickets/"):
+            with mock.patch.object(
+                RestaurantViewSet, "authentication_classes", [TokenAuthentication]
+            ), mock.patch.object(
+                RestaurantTicketViewSet, "authentication_classes", [TokenAuthentication]
+            ):
+                stock = self.requests_per_second(endpoint)
+            cached = self.requests_per_second(endpoint)
+
+            print(
+                f"{endpoint} requests/sec: "
+                f"TokenAuthentication={stock:.0f} CachedTokenAuthentication={cached:.0f}"
+            )
+
+
+LOGINS = 16
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class LoginStormBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.bulk_create(Ticket(restaurant=restaurant) for _ in range(10))
+
+    async def storm(self):
+        client = AsyncClient()
+        latencies = []
+        done = asyncio.Event()
+
+        async def logins():
+            await asyncio.gather(
+                *(
+                    client.post("/login/", {"username": "bench", "password": "bench"})
+                    for _ in range(LOGINS)
+                )
+            )
+            done.set()
+
+        async def browse():
+            while not done.is_set():
+                start = perf_counter()
+                await client.get("/tickets/", {"page": 1})
+                latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        await asyncio.gather(browse(), logins())
+        elapsed = perf_counter() - start
+
+        return {
+            "reads": len(latencies),
+            "elapsed": elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    async def test_ticket_reads_during_login_storm(self):
+        with override_settings(ROOT_URLCONF="restaurants_test.urls"):
+            sync_login = await self.storm()
+        with override_settings(ROOT_URLCONF="restaurants_test.asgi_urls"):
+            async_login = await self.storm()
+
+        print(f"\n/tickets/ reads during {LOGINS} concurrent logins over ASGI:")
+        for label, result in (("sync login", sync_login), ("async login", async_login)):
+            print(
+                f"  {label:<12} reads={result['reads']} p50={result['p50_ms']:.2f}ms "
+                f"p99={result['p99_ms']:.2f}ms total={result['elapsed']:.2f}s"
+            )
+
+
+METRICS_CALLS = 100_000
+
+
+class RequestMetricsBenchmark(TestCase):
+    """
+    Cost of RequestMetricsMiddleware around a view that does nothing, and of
+    the query timer around a trivial query. End-to-end request timings vary
+    far more than this between runs.
+    """
+
+    def microseconds_per_call(self, func, calls=METRICS_CALLS):
+        start = perf_counter()
+        for _ in range(calls):
+            func()
+        return (perf_counter() - start) / calls * 1_000_000
+
+    def test_overhead(self):
+        request = RequestFactory().get("/tickets/")
+        view = lambda request: HttpResponse()  # noqa: E731
+        middleware = RequestMetricsMiddleware(view)
+        bare = self.microseconds_per_call(lambda: view(request))
+        wrapped = self.microseconds_per_call(lambda: middleware(request))
+
+        def query():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        queries = METRICS_CALLS // 10
+        untimed = self.microseconds_per_call(query, queries)
+        token = metrics._query_stats.set(metrics.QueryStats())
+        try:
+            timed = self.microseconds_per_call(query, queries)
+        finally:
+            metrics._query_stats.reset(token)
+
+        print(
+            f"\nRequestMetricsMiddleware: +{wrapped - bare:.1f}us per request, "
+            f"+{timed - untimed:.1f}us per query"
+        )
+
+
+BULK_TICKETS = 5000
+SINGLE_TICKETS = 200
+
+
+class BulkTicketCreateBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        cls.token = Token.objects.create(user=user)
+        Restaurant.objects.create(owner=user)
+
+    def test_tickets_per_second(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        items = [
+            {"name": str(n), "max_purchase_count": 10} for n in range(BULK_TICKETS)
+        ]
+
+        start = perf_counter()
+        for item in items[:SINGLE_TICKETS]:
+            client.post("/restaurants/1/tickets/", item)
+        single = SINGLE_TICKETS / (perf_counter() - start)
+
+        start = perf_counter()
+        response = client.post("/restaurants/1/tickets/", items)
+        bulk = BULK_TICKETS / (perf_counter() - start)
+
+        self.assertEqual(len(response.data), BULK_TICKETS)
+        print(
+            f"\ntickets created/sec: one per request={single:.0f} "
+            f"{BULK_TICKETS} per request={bulk:.0f}"
+        )
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.checks import Error, Tags, register
+
+
+def per_process_cache_errors(aliases, id):
+    """
+    Errors for the cache aliases, given as `{alias: what it caches}`, whose
+    backend keeps its entries in each process.
+    """
+    errors = []
+    for alias, purpose in aliases.items():
+        try:
+            cache = caches[alias]
+        except InvalidCacheBackendError:
+            continue
+        if isinstance(cache, LocMemCache):
+            errors.append(
+                Error(
+                    f"The {purpose} cache {alias!r} uses {type(cache).__name__}, "
+                    "which is local to each process.",
+                    hint="Use a cache shared by all processes, such as the "
+                    '"redis" CACHE_PROFILE.',
+                    id=id,
+                )
+            )
+    return errors
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    profiling = getattr(settings, "REQUEST_PROFILING", {})
+    return per_process_cache_errors(
+        {getattr(settings, "AUTH_TOKEN_CACHE_ALIAS", "default"): "auth token"},
+        "app_restaurants.E001",
+    ) + per_process_cache_errors(
+        {profiling.get("CACHE_ALIAS", "profiling"): "slow request log"},
+        "app_restaurants.E002",
+    )
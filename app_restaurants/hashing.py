@@ -0,0 +1,42 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+class HashingPool:
+    """
+    Runs password hashing on a fixed number of worker threads.
+
+    At most `max_workers` hashes run at once and `max_queue` more may wait for
+    a worker; further calls fail immediately with PoolSaturated instead of
+    piling up behind a login storm.
+    """
+
+    def __init__(self, max_workers=2, max_queue=32, retry_after=1):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix="password-hashing"
+        )
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    @classmethod
+    def from_settings(cls, options):
+        return cls(**{name.lower(): value for name, value in options.items()})
+
+    async def run(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise PoolSaturated
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, partial(func, *args, **kwargs)
+            )
+        finally:
+            self._slots.release()
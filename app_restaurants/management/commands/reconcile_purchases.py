@@ -0,0 +1,108 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from app_restaurants.models import Ticket, TicketPurchase
+from app_restaurants.signals import tickets_bulk_saved
+
+
+def ledger_totals(**filters):
+    return dict(
+        TicketPurchase.objects.filter(**filters)
+        .order_by()
+        .values("ticket")
+        .annotate(total=Sum("amount"))
+        .values_list("ticket", "total")
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Check every ticket's purchase_count against the sum of its purchase "
+        "ledger, or rebuild it from the ledger with --fix."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Set purchase_count to the ledger total where they differ.",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Tickets whose ledger is summed per query.",
+        )
+
+    def handle(self, *args, **options):
+        checked, mismatched, fixed = 0, 0, 0
+        last_pk = 0
+        while True:
+            # Keyset pages of tickets, each with one grouped query over its
+            # range of the ledger, so memory does not grow with the ledger.
+            counts = dict(
+                Ticket.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", "purchase_count")[: options["chunk_size"]]
+            )
+            if not counts:
+                break
+            first_pk, last_pk = min(counts), max(counts)
+            totals = ledger_totals(ticket__gte=first_pk, ticket__lte=last_pk)
+            checked += len(counts)
+
+            suspects = [
+                pk for pk, count in counts.items() if totals.get(pk, 0) != count
+            ]
+            if suspects:
+                found, repaired = self.recheck(suspects, options["fix"])
+                mismatched += found
+                fixed += repaired
+
+        self.stdout.write(
+            f"Checked {checked} tickets, {mismatched} did not match the ledger"
+            + (f", fixed {fixed}." if options["fix"] else ".")
+        )
+        if mismatched > fixed:
+            raise CommandError(f"{mismatched - fixed} tickets do not match the ledger")
+
+    def recheck(self, pks, fix):
+        # A purchase may have committed between reading the counts and the
+        # ledger, so read both again with the tickets locked.
+        with transaction.atomic():
+            tickets = list(
+                Ticket.objects.select_for_update()
+                .filter(pk__in=pks)
+                .only("pk", "purchase_count", "max_purchase_count")
+            )
+            totals = ledger_totals(ticket__in=pks)
+
+            mismatched, repaired = 0, []
+            for ticket in tickets:
+                total = totals.get(ticket.pk, 0)
+                if total == ticket.purchase_count:
+                    continue
+                mismatched += 1
+                self.stdout.write(
+                    f"Ticket {ticket.pk}: purchase_count {ticket.purchase_count}, "
+                    f"ledger {total}"
+                )
+                if not fix:
+                    continue
+                if not 0 <= total <= ticket.max_purchase_count:
+                    self.stderr.write(
+                        f"Ticket {ticket.pk}: ledger total is outside "
+                        f"0..{ticket.max_purchase_count}, not fixed"
+                    )
+                    continue
+                Ticket.objects.filter(pk=ticket.pk).update(
+                    purchase_count=total, updated_at=timezone.now()
+                )
+                ticket.purchase_count = total
+                repaired.append(ticket)
+
+        if repaired:
+            tickets_bulk_saved.send(sender=Ticket, tickets=repaired)
+        return mismatched, len(repaired)
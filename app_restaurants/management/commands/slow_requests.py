@@ -0,0 +1,30 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app_restaurants.profiling import SlowRequestLog, profiling_token
+
+
+class Command(BaseCommand):
+    help = "Dump the slow request log as JSON, oldest first."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clear", action="store_true", help="Empty the log after dumping it."
+        )
+        parser.add_argument(
+            "--token",
+            action="store_true",
+            help="Print a token for the X-Profile-Token header instead.",
+        )
+
+    def handle(self, *args, **options):
+        if options["token"]:
+            self.stdout.write(profiling_token())
+            return
+
+        log = SlowRequestLog.from_settings(getattr(settings, "REQUEST_PROFILING", {}))
+        self.stdout.write(json.dumps(log.records(), indent=2))
+        if options["clear"]:
+            log.clear()
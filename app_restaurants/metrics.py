@@ -0,0 +1,284 @@
+"""
+Per-request timings: total time, database time and query count, by view.
+
+RequestMetricsMiddleware adds them to each response as a Server-Timing header
+and aggregates them into histograms served in the Prometheus text format by
+the `metrics` view, along with the counters other modules register with
+`register_counters`. Histograms and counters are kept per process.
+
+Both the header and the view are only for monitoring clients: staff users and
+clients in the REQUEST_METRICS["INTERNAL_NETWORKS"].
+"""
+import ipaddress
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework import permissions, renderers
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.response import Response
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Any other method is counted as "other", so clients cannot add series.
+METHODS = {"GET", "HEAD", "OPTIONS", "POST", "PUT", "PATCH", "DELETE"}
+
+_query_stats = ContextVar("query_stats", default=None)
+
+
+class QueryStats:
+    __slots__ = ("count", "duration")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _query_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.count += 1
+        stats.duration += perf_counter() - start
+
+
+def label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def internal_networks():
+    options = getattr(settings, "REQUEST_METRICS", {})
+    return [
+        ipaddress.ip_network(network)
+        for network in options.get("INTERNAL_NETWORKS", [])
+    ]
+
+
+def internal_client(request, networks):
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    return any(address in network for network in networks)
+
+
+def monitoring_client(request, networks=None):
+    """Whether the request comes from a staff user or an internal network."""
+    if networks is None:
+        networks = internal_networks()
+    if internal_client(request, networks):
+        return True
+    user = getattr(request, "user", None)
+    return bool(user and user.is_staff)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip([*self.buckets, "+Inf"], self.counts):
+            total += count
+            yield bound, total
+
+
+class RequestMetrics:
+    histograms = {
+        "http_request_duration_seconds": (
+            "Time spent handling requests.",
+            DURATION_BUCKETS,
+        ),
+        "http_request_db_duration_seconds": (
+            "Time spent in database queries per request.",
+            DURATION_BUCKETS,
+        ),
+        "http_request_db_queries": (
+            "Database queries per request.",
+            QUERY_BUCKETS,
+        ),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, view, method, duration, stats):
+        if method not in METHODS:
+            method = "other"
+        values = {
+            "http_request_duration_seconds": duration,
+            "http_request_db_duration_seconds": stats.duration,
+            "http_request_db_queries": stats.count,
+        }
+        with self._lock:
+            for name, value in values.items():
+                histogram = self._series.get((name, view, method))
+                if histogram is None:
+                    histogram = Histogram(self.histograms[name][1])
+                    self._series[name, view, method] = histogram
+                histogram.observe(value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in self.histograms.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for (series, view, method), histogram in sorted(self._series.items()):
+                    if series != name:
+                        continue
+                    labels = (
+                        f'view="{label_value(view)}",method="{label_value(method)}"'
+                    )
+                    for bound, count in histogram.samples():
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics()
+
+# Functions returning `{name: (help text, value)}` of counters kept by other
+# modules, served after the histograms. Values of None are left out.
+counter_sources = []
+
+
+def register_counters(func):
+    counter_sources.append(func)
+    return func
+
+
+def render_counters():
+    lines = []
+    for source in counter_sources:
+        for name, (help_text, value) in source().items():
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+    return "".join(f"{line}\n" for line in lines)
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    view = getattr(match.func, "cls", match.func)
+    label = getattr(view, "__name__", type(view).__name__)
+    action = (getattr(match.func, "actions", None) or {}).get(request.method.lower())
+    if action:
+        label = f"{label}.{action}"
+    return label
+
+
+class RequestMetricsMiddleware:
+    """
+    Time each request and its database queries.
+
+    Queries are counted by `record_query`, which is installed on every
+    database connection (see app_restaurants.signals), so queries the async
+    ORM runs in worker threads count towards the request that made them.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        options = getattr(settings, "REQUEST_METRICS", {})
+        if not options.get("ENABLED", True):
+            raise MiddlewareNotUsed
+        self.server_timing = options.get("SERVER_TIMING", True)
+        self.internal_networks = internal_networks()
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        stats = QueryStats()
+        token = _query_stats.set(stats)
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _query_stats.reset(token)
+        return self.finish(request, response, perf_counter() - start, stats)
+
+    async def __acall__(self, request):
+        stats = QueryStats()
+        token = _query_stats.set(stats)
+        start = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _query_stats.reset(token)
+        duration = perf_counter() - start
+        request_metrics.observe(view_label(request), request.method, duration, stats)
+        if self.server_timing and (
+            internal_client(request, self.internal_networks)
+            # request.user may still be the lazy session user, loaded by a
+            # query.
+            or await sync_to_async(monitoring_client)(request, self.internal_networks)
+        ):
+            self.add_server_timing(response, duration, stats)
+        return response
+
+    def finish(self, request, response, duration, stats):
+        request_metrics.observe(view_label(request), request.method, duration, stats)
+        if self.server_timing and monitoring_client(request, self.internal_networks):
+            self.add_server_timing(response, duration, stats)
+        return response
+
+    @staticmethod
+    def add_server_timing(response, duration, stats):
+        response["Server-Timing"] = (
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", '
+            f"total;dur={duration * 1000:.2f}"
+        )
+
+
+class IsMonitoringClient(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return monitoring_client(request)
+
+
+class PrometheusRenderer(renderers.BaseRenderer):
+    media_type = "text/plain"
+    format = "txt"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            # An error response.
+            data = f"{data['detail']}\n"
+        return data.encode(self.charset)
+
+
+@api_view(["GET"])
+@permission_classes([IsMonitoringClient])
+@renderer_classes([PrometheusRenderer])
+def metrics(request):
+    return Response(
+        request_metrics.render() + render_counters(),
+        content_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,56 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("app_restaurants", "0002_ticket_updated_at"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="restaurant",
+            name="owner",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="restaurants",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="ticket",
+            name="restaurant",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="tickets",
+                to="app_restaurants.restaurant",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="restaurant",
+            index=models.Index(fields=["owner", "id"], name="restaurant_owner_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(
+                fields=["restaurant", "id"], name="ticket_restaurant_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(
+                condition=models.Q(
+                    ("purchase_count__lt", models.F("max_purchase_count"))
+                ),
+                fields=["id"],
+                name="ticket_available_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:22
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app_restaurants", "0003_ticket_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(
+                django.db.models.expressions.CombinedExpression(
+                    models.F("max_purchase_count"), "-", models.F("purchase_count")
+                ),
+                models.F("id"),
+                name="ticket_purchase_left_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app_restaurants", "0004_ticket_purchase_left_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ticket",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app_restaurants", "0005_ticket_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TicketPurchase",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("amount", models.IntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "ticket",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        db_index=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="purchases",
+                        to="app_restaurants.ticket",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["ticket", "amount"], name="purchase_ticket_amount_idx"
+                    )
+                ],
+            },
+        ),
+    ]
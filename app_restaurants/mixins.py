@@ -0,0 +1,27 @@
+from rest_framework.response import Response
+
+
+def rows_to_dicts(rows, fields):
+    return [{name: row[source] for name, source in fields.items()} for row in rows]
+
+
+class ValuesListMixin:
+    """
+    Serve `list` from `values()` rows instead of a ModelSerializer.
+
+    `list_fields` maps each output key to a field, annotation or related
+    lookup (e.g. "restaurant__name"). It must produce the same keys, in the
+    same order, as the serializer, so both paths render identical JSON.
+    """
+
+    list_fields = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            *self.list_fields.values()
+        )
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(rows_to_dicts(page, self.list_fields))
+        return Response(rows_to_dicts(queryset, self.list_fields))
@@ -1,22 +1,478 @@
-from django.db import IntegrityError, models
+import copy
+
+from django.db import (
+    IntegrityError,
+    OperationalError,
+    connections,
+    models,
+    router,
+    transaction,
+)
+from django.db.models import Case, Count, F, Q, Sum, Value, When
+from django.utils import timezone
+
+
+class RestaurantQuerySet(models.QuerySet):
+    def with_ticket_stats(self):
+        """Annotate ticket count and sums of sold, capacity and remaining."""
+        return self.annotate(
+            ticket_count=Count("tickets"),
+            total_sold=Sum("tickets__purchase_count", default=0),
+            total_capacity=Sum("tickets__max_purchase_count", default=0),
+        ).annotate(total_remaining=F("total_capacity") - F("total_sold"))
 
 
 class Restaurant(models.Model):
     name = models.CharField(max_length=100)
     owner = models.ForeignKey(
-        "auth.User", related_name="restaurants", on_delete=models.PROTECT
+        "auth.User",
+        related_name="restaurants",
+        on_delete=models.PROTECT,
+        db_index=False,
     )
 
+    objects = RestaurantQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # RestaurantViewSet: the user's restaurants, in id order.
+            models.Index(fields=["owner", "id"], name="restaurant_owner_id_idx"),
+        ]
+
+
+def field_maximum(queryset, name):
+    """The largest value the database column of integer field `name` holds."""
+    field = queryset.model._meta.get_field(name)
+    internal_type = getattr(field, "target_field", field).get_internal_type()
+    maximum = connections[queryset.db].ops.integer_field_range(internal_type)[1]
+    # SQLite reports no range before Django 5.0, but stores 64-bit integers.
+    return 2 ** 63 - 1 if maximum is None else maximum
+
+
+def supports_update_returning(connection):
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "sqlite":
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+    return False
+
+
+class TicketQuerySet(models.QuerySet):
+    def with_purchase_left(self):
+        return self.annotate(
+            purchase_left=F("max_purchase_count") - F("purchase_count")
+        )
+
+    def public(self):
+        return self.select_related("restaurant").with_purchase_left()
+
+    def purchase(self, pk, amount):
+        """
+        Add `amount` to the ticket's purchase_count in a single guarded UPDATE.
+
+        Returns the updated ticket (with its restaurant name and purchase_left
+        loaded, like `public()` does), or None
+        when no row matched: the ticket does not exist or the new count would
+        leave the 0..max_purchase_count range.
+        """
+        with transaction.atomic(using=self.db, savepoint=False):
+            return self._purchase(pk, amount, recorded=[amount])
+
+    def _purchase(self, pk, amount, recorded=()):
+        # `recorded`: the ledger amounts that add up to `amount`, written with
+        # the update.
+        recorded = [entry for entry in recorded if entry]
+        connection = connections[self.db]
+        if supports_update_returning(connection):
+            return self._purchase_returning(connection, pk, amount, recorded)
+
+        updated = (
+            self.filter(pk=pk)
+            .alias(new_purchase_count=F("purchase_count") + amount)
+            .filter(
+                new_purchase_count__gte=0,
+                new_purchase_count__lte=F("max_purchase_count"),
+            )
+            .update(
+                purchase_count=F("purchase_count") + amount, updated_at=timezone.now()
+            )
+        )
+        if not updated:
+            return None
+        self.record_purchases((pk, entry) for entry in recorded)
+        return self.public().get(pk=pk)
+
+    def purchase_batch(self, entries):
+        """
+        Make the `(ticket id, amount)` purchases in order in one transaction,
+        up to the first one rejected.
+
+        Returns the tickets as the purchases left them, ending with None if
+        one was rejected. The accepted purchases are written to the ledger
+        with one INSERT.
+        """
+        tickets, accepted = [], []
+        with transaction.atomic(using=self.db, savepoint=False):
+            for pk, amount in entries:
+                ticket = self._purchase(pk, amount)
+                tickets.append(ticket)
+                if ticket is None:
+                    break
+                accepted.append((pk, amount))
+            self.record_purchases(accepted)
+        return tickets
+
+    def purchase_many(self, pk, amounts):
+        """
+        Settle several purchases of one ticket as if they ran one by one in
+        the given order.
+
+        Returns one entry per amount: the ticket as that purchase left it, or
+        None when the purchase was rejected. The accepted purchases are
+        written to the ledger with one INSERT, in the transaction of the
+        counter update; on PostgreSQL, when they are all accepted at once, in
+        its statement.
+        """
+        # A total beyond the column's range can't be accepted at once and
+        # could overflow the UPDATE, so such purchases are settled one by one.
+        total = sum(amounts)
+        if abs(total) <= field_maximum(self, "purchase_count") and (
+            all(amount >= 0 for amount in amounts)
+            or all(amount <= 0 for amount in amounts)
+        ):
+            with transaction.atomic(using=self.db, savepoint=False):
+                ticket = self._purchase(pk, total, recorded=amounts)
+            if ticket is not None:
+                start = ticket.purchase_count - total
+                return self._purchase_snapshots(ticket, start, amounts, amounts)
+
+        with transaction.atomic(using=self.db):
+            # Lock the ticket row only, not the restaurant public() joins.
+            ticket = self.select_for_update(of=("self",)).public().filter(pk=pk).first()
+            if ticket is None:
+                return [None] * len(amounts)
+
+            count = ticket.purchase_count
+            accepted = []
+            for amount in amounts:
+                if 0 <= count + amount <= ticket.max_purchase_count:
+                    count += amount
+                    accepted.append(amount)
+                else:
+                    accepted.append(None)
+
+            if count != ticket.purchase_count:
+                updated = self.filter(
+                    pk=pk, purchase_count=ticket.purchase_count
+                ).update(purchase_count=count, updated_at=timezone.now())
+                if not updated:
+                    raise OperationalError("Ticket was modified concurrently")
+            self.record_purchases(
+                (pk, amount) for amount in accepted if amount is not None
+            )
+
+        return self._purchase_snapshots(
+            ticket, ticket.purchase_count, amounts, accepted
+        )
+
+    def update_many(self, changes, batch_size=None):
+        """
+        Apply `{"id": ..., <field>: <value>}` changes to name and
+        max_purchase_count in one transaction, with one CASE UPDATE per batch.
+
+        Returns `(updated, rejected)`, both mapping ids to tickets: the
+        updated tickets with their new values, and the tickets left unchanged
+        because the new max_purchase_count is below their purchase_count,
+        including a purchase_count raised by a purchase after the tickets were
+        read. Ids with no ticket in this queryset are in neither.
+        """
+        updated, rejected = {}, {}
+        with transaction.atomic(using=self.db):
+            tickets = self.select_for_update(of=("self",)).in_bulk(
+                [change["id"] for change in changes]
+            )
+            now = timezone.now()
+            applied = []
+            for change in changes:
+                ticket = tickets.get(change["id"])
+                if ticket is None:
+                    continue
+                max_purchase_count = change.get(
+                    "max_purchase_count", ticket.max_purchase_count
+                )
+                if ticket.purchase_count > max_purchase_count:
+                    rejected[ticket.pk] = ticket
+                    continue
+                for field, value in change.items():
+                    setattr(ticket, field, value)
+                ticket.updated_at = now
+                ticket.version += 1
+                applied.append(change)
+                updated[ticket.pk] = ticket
+
+            batch_size = batch_size or len(applied) or 1
+            for start in range(0, len(applied), batch_size):
+                batch = applied[start : start + batch_size]
+                values = {}
+                for name in ("name", "max_purchase_count"):
+                    field = self.model._meta.get_field(name)
+                    whens = [
+                        When(pk=change["id"], then=Value(change[name], field))
+                        for change in batch
+                        if name in change
+                    ]
+                    if whens:
+                        values[name] = Case(*whens, default=F(name), output_field=field)
+                # The invariant Ticket.save() checks, enforced by the UPDATE
+                # itself.
+                new_max = values.get("max_purchase_count", F("max_purchase_count"))
+                ids = [change["id"] for change in batch]
+                base = self.model._base_manager.using(self.db)
+                rows = base.filter(pk__in=ids, purchase_count__lte=new_max).update(
+                    version=F("version") + 1, updated_at=now, **values
+                )
+                if rows == len(batch):
+                    continue
+                # A purchase got in after the read (the lock does not hold on
+                # every backend): the rows it pushed past their new maximum
+                # were skipped by the UPDATE, and this transaction's write
+                # keeps them as they were while they are read again.
+                current = base.in_bulk(ids)
+                for change in batch:
+                    ticket = current.get(change["id"])
+                    del updated[change["id"]]
+                    if ticket is None:
+                        continue
+                    if ticket.purchase_count > change.get(
+                        "max_purchase_count", ticket.max_purchase_count
+                    ):
+                        rejected[ticket.pk] = ticket
+                    else:
+                        updated[ticket.pk] = ticket
+
+        return updated, rejected
+
+    def update_versioned(self, pk, values, version=None):
+        """
+        Write only the columns in `values` with one UPDATE that bumps the
+        ticket's version, so purchases made since the ticket was read are
+        kept.
+
+        With `version`, the ticket is only updated if it is still at that
+        version. The UPDATE also checks the purchase_count <= max_purchase_count
+        invariant. Returns the new version and the purchase_count the ticket
+        was left with, or None when no row matched.
+        """
+        if "purchase_count" in values:
+            # The ledger needs the change, so read the count under lock first.
+            with transaction.atomic(using=self.db, savepoint=False):
+                current = (
+                    self.select_for_update()
+                    .filter(pk=pk)
+                    .values_list("purchase_count", flat=True)
+                    .first()
+                )
+                if current is None:
+                    return None
+                updated = self._update_versioned(
+                    self.filter(pk=pk, purchase_count=current), pk, values, version
+                )
+                if updated is not None:
+                    self.record_purchases([(pk, values["purchase_count"] - current)])
+                return updated
+        with transaction.atomic(using=self.db, savepoint=False):
+            return self._update_versioned(self.filter(pk=pk), pk, values, version)
+
+    def _update_versioned(self, queryset, pk, values, version):
+        if version is not None:
+            queryset = queryset.filter(version=version)
+        rows = (
+            queryset.alias(
+                new_purchase_count=Value(values["purchase_count"])
+                if "purchase_count" in values
+                else F("purchase_count"),
+                new_max_purchase_count=Value(values["max_purchase_count"])
+                if "max_purchase_count" in values
+                else F("max_purchase_count"),
+            )
+            .filter(new_purchase_count__lte=F("new_max_purchase_count"))
+            .update(version=F("version") + 1, updated_at=timezone.now(), **values)
+        )
+        if not rows:
+            return None
+        # Read back in the transaction of the UPDATE, which still holds the
+        # row, for the purchase_count the callers did not write.
+        return self.filter(pk=pk).values_list("version", "purchase_count").first()
+
+    def record_purchases(self, entries):
+        """Append `(ticket id, amount)` entries to the purchase ledger."""
+        TicketPurchase.objects.using(self.db).bulk_create(
+            TicketPurchase(ticket_id=pk, amount=amount)
+            for pk, amount in entries
+            if amount
+        )
+
+    @staticmethod
+    def _purchase_snapshots(ticket, start, amounts, accepted):
+        snapshots = []
+        count = start
+        for amount, accepted_amount in zip(amounts, accepted):
+            if accepted_amount is None:
+                snapshots.append(None)
+                continue
+            count += amount
+            snapshot = copy.copy(ticket)
+            snapshot.purchase_count = count
+            snapshot.purchase_left = ticket.max_purchase_count - count
+            snapshots.append(snapshot)
+        return snapshots
+
+    def _purchase_returning(self, connection, pk, amount, recorded):
+        qn = connection.ops.quote_name
+        ticket_table = qn(Ticket._meta.db_table)
+        restaurant_table = qn(Restaurant._meta.db_table)
+        fields = ["id", "name", "max_purchase_count", "purchase_count", "restaurant_id"]
+        updated_at = Ticket._meta.get_field("updated_at").get_db_prep_value(
+            timezone.now(), connection
+        )
+
+        sql = (
+            f"UPDATE {ticket_table} "
+            f"SET {qn('purchase_count')} = {qn('purchase_count')} + %s, "
+            f"{qn('updated_at')} = %s "
+            f"WHERE {qn('id')} = %s "
+            f"AND {qn('purchase_count')} + %s >= 0 "
+            f"AND {qn('purchase_count')} + %s <= {qn('max_purchase_count')} "
+            f"RETURNING {', '.join(f'{ticket_table}.{qn(f)}' for f in fields)}, "
+            f"{qn('max_purchase_count')} - {qn('purchase_count')} "
+            f"AS {qn('purchase_left')}, "
+            f"(SELECT {restaurant_table}.{qn('name')} FROM {restaurant_table} "
+            f"WHERE {restaurant_table}.{qn('id')} = {ticket_table}.{qn('restaurant_id')}) "
+            f"AS {qn('restaurant_name')}"
+        )
+        params = [amount, updated_at, pk, amount, amount]
+        if recorded and connection.vendor == "postgresql":
+            # The ledger rows are inserted by the same statement, in order,
+            # for the row the UPDATE returned.
+            purchase_table = qn(TicketPurchase._meta.db_table)
+            sql = (
+                f"WITH {qn('updated')} AS ({sql}), {qn('recorded')} AS ("
+                f"INSERT INTO {purchase_table} "
+                f"({qn('ticket_id')}, {qn('amount')}, {qn('created_at')}) "
+                f"SELECT {qn('updated')}.{qn('id')}, {qn('entry')}.{qn('amount')}, %s "
+                f"FROM {qn('updated')}, "
+                f"unnest(%s::integer[]) WITH ORDINALITY "
+                f"AS {qn('entry')} ({qn('amount')}, {qn('position')}) "
+                f"ORDER BY {qn('entry')}.{qn('position')}"
+                f") SELECT * FROM {qn('updated')}"
+            )
+            params += [updated_at, recorded]
+            recorded = []
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+
+        if row is None:
+            return None
+        self.record_purchases((pk, entry) for entry in recorded)
+        ticket = Ticket.from_db(self.db, fields, row[: len(fields)])
+        ticket.purchase_left, restaurant_name = row[len(fields) :]
+        ticket.restaurant = Restaurant.from_db(
+            self.db, ["id", "name"], [ticket.restaurant_id, restaurant_name]
+        )
+        return ticket
+
 
 class Ticket(models.Model):
     name = models.CharField(max_length=100)
     max_purchase_count = models.PositiveIntegerField(default=0)
     purchase_count = models.PositiveIntegerField(default=0)
     restaurant = models.ForeignKey(
-        Restaurant, related_name="tickets", on_delete=models.CASCADE
+        Restaurant, related_name="tickets", on_delete=models.CASCADE, db_index=False
     )
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Bumped by owner edits, not by purchases, see TicketQuerySet.update_versioned
+    version = models.PositiveIntegerField(default=0)
+
+    objects = TicketQuerySet.as_manager()
+
+    class Meta:
+        # Purchases change purchase_count, which ticket_available_idx and
+        # ticket_purchase_left_idx depend on, so on PostgreSQL a purchase
+        # writes an entry to each of them and is never a HOT update. They are
+        # kept for the catalog queries below, like the index on updated_at,
+        # which purchases set, for ticket_export's ?updated_since=; other
+        # columns stay unindexed.
+        indexes = [
+            # RestaurantTicketViewSet: a restaurant's tickets, in id order.
+            models.Index(fields=["restaurant", "id"], name="ticket_restaurant_id_idx"),
+            # PublicTicketList with ?available=true: in stock tickets, in id
+            # order, without reading the sold out ones.
+            models.Index(
+                fields=["id"],
+                condition=Q(purchase_count__lt=F("max_purchase_count")),
+                name="ticket_available_idx",
+            ),
+            # PublicTicketList with ?ordering=(-)purchase_left or ?min_left=:
+            # tickets by purchase_left, ties broken on id.
+            models.Index(
+                F("max_purchase_count") - F("purchase_count"),
+                F("id"),
+                name="ticket_purchase_left_idx",
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if self.purchase_count > self.max_purchase_count:
             raise IntegrityError
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "purchase_count" not in update_fields:
+            return super().save(*args, **kwargs)
+
+        # The ledger records the change from the stored count, read under lock
+        # first, like update_versioned does; a new ticket opens it with its
+        # initial count.
+        using = kwargs.get("using") or router.db_for_write(Ticket, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            stored = 0
+            if self.pk is not None:
+                stored = (
+                    Ticket.objects.using(using)
+                    .select_for_update()
+                    .filter(pk=self.pk)
+                    .values_list("purchase_count", flat=True)
+                    .first()
+                ) or 0
+            super().save(*args, **kwargs)
+            Ticket.objects.using(using).record_purchases(
+                [(self.pk, self.purchase_count - stored)]
+            )
+
+
+class TicketPurchase(models.Model):
+    """
+    Append-only ledger of changes to Ticket.purchase_count: purchases, refunds
+    (negative amounts) and counts set by owners. Rows are only ever inserted,
+    in the transaction that changes the counter, so the amounts of a ticket
+    add up to its purchase_count (see `manage.py reconcile_purchases`). They
+    are kept when their ticket is deleted.
+    """
+
+    # Rows outlive their ticket, so deleting a ticket keeps its history.
+    ticket = models.ForeignKey(
+        Ticket,
+        related_name="purchases",
+        on_delete=models.DO_NOTHING,
+        db_index=False,
+        db_constraint=False,
+    )
+    amount = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Covers the per-ticket sums of reconcile_purchases.
+            models.Index(
+                fields=["ticket", "amount"], name="purchase_ticket_amount_idx"
+            ),
+        ]
@@ -0,0 +1,53 @@
+from django.conf import settings
+from rest_framework.pagination import (
+    BasePagination,
+    CursorPagination,
+    PageNumberPagination,
+)
+
+
+class TicketCursorPagination(CursorPagination):
+    ordering = "id"
+
+
+class TicketPagination(BasePagination):
+    """
+    Page number or keyset (cursor on the view ordering, `id` by default)
+    pagination for ticket lists.
+
+    Keyset pagination skips the COUNT(*) and OFFSET scans of page numbers. It
+    is picked with `?pagination=cursor` (or by following a `?cursor=` link),
+    and becomes the default with settings.TICKET_PAGINATION = "cursor".
+    """
+
+    pagination_query_param = "pagination"
+    paginators = {
+        "page": PageNumberPagination,
+        "cursor": TicketCursorPagination,
+    }
+
+    def __init__(self):
+        self.paginator = None
+
+    def get_paginator(self, request):
+        mode = request.query_params.get(self.pagination_query_param)
+        if mode not in self.paginators:
+            if TicketCursorPagination.cursor_query_param in request.query_params:
+                mode = "cursor"
+            else:
+                mode = getattr(settings, "TICKET_PAGINATION", "page")
+        return self.paginators[mode]()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.paginator = self.get_paginator(request)
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    def to_html(self):
+        return self.paginator.to_html()
+
+    @property
+    def display_page_controls(self):
+        return getattr(self.paginator, "display_page_controls", False)
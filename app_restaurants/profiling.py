@@ -0,0 +1,219 @@
+"""
+Opt-in request profiling and a log of slow requests.
+
+A request is profiled when it carries a valid X-Profile-Token header (see
+`profiling_token`) or is picked by the sampling rate. It then runs under
+cProfile, and its hottest functions and SQL statements are kept with the
+request in the slow request log, along with every request slower than the
+threshold. The log is a ring buffer in a cache shared by all processes, which
+`manage.py slow_requests` dumps. Its slots are handed out by the cache's
+incr(), so the cache must make it atomic: Redis does, and so does
+LockingFileBasedCache for the processes of one host.
+
+Async requests are timed for the slow request log but never profiled, and
+their records are written from a worker thread.
+"""
+import cProfile
+import os
+import pstats
+import random
+from contextlib import ExitStack, contextmanager
+from time import perf_counter
+from uuid import uuid4
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files import locks
+from django.db import connections
+from django.utils import timezone
+
+from .metrics import view_label
+
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+PROFILE_TOKEN_SALT = "app_restaurants.profiling"
+
+
+def profiling_token():
+    return signing.TimestampSigner(salt=PROFILE_TOKEN_SALT).sign("profile")
+
+
+def hot_functions(profiler, limit):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+    return [
+        {
+            "function": pstats.func_std_string(function),
+            "calls": calls,
+            "own_ms": round(own_time * 1000, 3),
+            "cumulative_ms": round(cumulative_time * 1000, 3),
+        }
+        for function, (_, calls, own_time, cumulative_time, _) in rows[:limit]
+    ]
+
+
+class LockingFileBasedCache(FileBasedCache):
+    """FileBasedCache whose add() and incr() hold a lock file of the cache."""
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self._dir, exist_ok=True)
+        with open(os.path.join(self._dir, "lock"), "wb") as lock_file:
+            locks.lock(lock_file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(lock_file)
+
+    def add(self, *args, **kwargs):
+        with self._locked():
+            return super().add(*args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        with self._locked():
+            return super().incr(*args, **kwargs)
+
+
+class SlowRequestLog:
+    """Ring buffer of request records kept in a cache."""
+
+    def __init__(self, alias="profiling", size=100):
+        self.alias = alias
+        self.size = size
+
+    @classmethod
+    def from_settings(cls, options):
+        return cls(
+            alias=options.get("CACHE_ALIAS", "profiling"),
+            size=options.get("SLOW_REQUEST_LOG_SIZE", 100),
+        )
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def slot_keys(self):
+        return [f"profiling:slow:{slot}" for slot in range(self.size)]
+
+    def append(self, record):
+        self.cache.add("profiling:slow:next", 0, timeout=None)
+        try:
+            seq = self.cache.incr("profiling:slow:next")
+        except ValueError:
+            seq = 1
+            self.cache.set("profiling:slow:next", seq, timeout=None)
+        record["seq"] = seq
+        self.cache.set(self.slot_keys()[seq % self.size], record, timeout=None)
+
+    def records(self):
+        records = self.cache.get_many(self.slot_keys()).values()
+        return sorted(records, key=lambda record: record["seq"])
+
+    def clear(self):
+        self.cache.delete_many(self.slot_keys() + ["profiling:slow:next"])
+
+
+class RequestProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        options = getattr(settings, "REQUEST_PROFILING", {})
+        if not options.get("ENABLED", True):
+            raise MiddlewareNotUsed
+        self.sample_rate = options.get("SAMPLE_RATE", 0)
+        self.token_max_age = options.get("TOKEN_MAX_AGE", 60 * 60)
+        self.top_functions = options.get("TOP_FUNCTIONS", 20)
+        self.threshold = options.get("SLOW_REQUEST_THRESHOLD", 0.5)
+        self.log = SlowRequestLog.from_settings(options)
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.should_profile(request):
+            return self.profile(request)
+
+        start = perf_counter()
+        response = self.get_response(request)
+        self.finish(request, response, perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        start = perf_counter()
+        response = await self.get_response(request)
+        duration = perf_counter() - start
+        if duration >= self.threshold:
+            # The log is written to the cache with blocking I/O.
+            await sync_to_async(self.finish, thread_sensitive=False)(
+                request, response, duration
+            )
+        return response
+
+    def should_profile(self, request):
+        token = request.headers.get(PROFILE_TOKEN_HEADER)
+        if token:
+            try:
+                signing.TimestampSigner(salt=PROFILE_TOKEN_SALT).unsign(
+                    token, max_age=self.token_max_age
+                )
+            except signing.BadSignature:
+                return False
+            return True
+        return random.random() < self.sample_rate
+
+    def profile(self, request):
+        profiler = cProfile.Profile()
+        queries = []
+
+        def capture_query(execute, sql, params, many, context):
+            start = perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                duration = perf_counter() - start
+                queries.append({"sql": sql, "ms": round(duration * 1000, 3)})
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(capture_query))
+            start = perf_counter()
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            duration = perf_counter() - start
+
+        record = self.finish(
+            request,
+            response,
+            duration,
+            functions=hot_functions(profiler, self.top_functions),
+            queries=queries,
+        )
+        response["X-Profile-Id"] = record["id"]
+        return response
+
+    def finish(self, request, response, duration, **profile):
+        if not profile and duration < self.threshold:
+            return None
+        record = {
+            "id": uuid4().hex,
+            "time": timezone.now().isoformat(),
+            "method": request.method,
+            "path": request.get_full_path(),
+            "view": view_label(request),
+            "status": response.status_code,
+            "ms": round(duration * 1000, 3),
+            "profiled": bool(profile),
+            **profile,
+        }
+        self.log.append(record)
+        return record
@@ -12,7 +12,49 @@ class RestaurantSerializer(serializers.ModelSerializer):
         ]
 
 
+class RestaurantStatsSerializer(RestaurantSerializer):
+    """RestaurantSerializer for restaurants annotated with `with_ticket_stats()`."""
+
+    ticket_count = serializers.IntegerField(read_only=True)
+    total_sold = serializers.IntegerField(read_only=True)
+    total_capacity = serializers.IntegerField(read_only=True)
+    total_remaining = serializers.IntegerField(read_only=True)
+
+    class Meta(RestaurantSerializer.Meta):
+        fields = RestaurantSerializer.Meta.fields + [
+            "ticket_count",
+            "total_sold",
+            "total_capacity",
+            "total_remaining",
+        ]
+
+
 class TicketSerializer(serializers.ModelSerializer):
     class Meta:
         model = Ticket
         fields = ["id", "name", "max_purchase_count", "purchase_count"]
+
+
+class TicketCreateSerializer(TicketSerializer):
+    """TicketSerializer that also checks the counts Ticket.save() would."""
+
+    def validate(self, attrs):
+        if attrs.get("purchase_count", 0) > attrs.get("max_purchase_count", 0):
+            raise serializers.ValidationError(
+                {"purchase_count": "Cannot exceed max_purchase_count."}
+            )
+        return attrs
+
+
+class TicketBulkUpdateSerializer(serializers.ModelSerializer):
+    """One item of a bulk ticket update, the ticket id and the fields to set."""
+
+    id = serializers.IntegerField()
+
+    class Meta:
+        model = Ticket
+        fields = ["id", "name", "max_purchase_count"]
+        extra_kwargs = {
+            "name": {"required": False},
+            "max_purchase_count": {"required": False},
+        }
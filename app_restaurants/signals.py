@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_cache, token_cache_key
+from .metrics import record_query
+
+# Sent with the written tickets after a bulk write, which skips post_save.
+tickets_bulk_saved = Signal()
+
+
+@receiver(post_delete, sender=Token)
+def forget_token(sender, instance, **kwargs):
+    token_cache().delete(token_cache_key(instance.key))
+
+
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, created, **kwargs):
+    if created:
+        return
+    keys = [
+        token_cache_key(key)
+        for key in Token.objects.filter(user=instance).values_list("key", flat=True)
+    ]
+    if keys:
+        token_cache().delete_many(keys)
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        for name, value in getattr(settings, "SQLITE_PRAGMAS", {}).items():
+            connection.connection.execute(f"PRAGMA {name} = {value}")
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -1,10 +1,46 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, make_password
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.contrib.auth.signals import user_login_failed
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.models import F
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
 from rest_framework import status
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APIClient
-
-from app_restaurants.models import Restaurant, Ticket
+from rest_framework.mixins import ListModelMixin
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from app_restaurants import async_views, checks, metrics
+from app_restaurants.authentication import (
+    CachedTokenAuthentication,
+    token_cache,
+    token_cache_key,
+)
+from app_restaurants.hashing import HashingPool
+from app_restaurants.metrics import RequestMetrics
+from app_restaurants.mixins import ValuesListMixin
+from app_restaurants.models import Restaurant, Ticket, TicketPurchase, TicketQuerySet
+from app_restaurants.profiling import (
+    LockingFileBasedCache,
+    SlowRequestLog,
+    profiling_token,
+)
+from app_restaurants.views import RestaurantTicketViewSet, RestaurantViewSet
+from app_tickets.async_views import close_thread_connections
+from app_tickets.views import PublicTicketList
 
 
 class AuthorizationTests(TestCase):
@@ -44,6 +80,14 @@ class AuthorizationTests(TestCase):
 
         self.assertEqual(response_empty_body.status_code, status.HTTP_400_BAD_REQUEST)
 
+        response_empty_username = client.post(
+            endpoint, {"username": "", "password": "test"}
+        )
+
+        self.assertEqual(
+            response_empty_username.status_code, status.HTTP_400_BAD_REQUEST
+        )
+
     def test_login(self):
         User.objects.create_user("test", password="test")
 
@@ -78,12 +122,13 @@ class RestaurantsTests(TestCase):
         client = APIClient()
 
         list_create = ["GET", "HEAD", "OPTIONS", "POST"]
+        list_create_update = ["GET", "HEAD", "OPTIONS", "PATCH", "POST"]
         retrieve_update_destroy = ["DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "PUT"]
 
         endpoints = (
             ("/restaurants/", list_create),
             ("/restaurants/1/", retrieve_update_destroy),
-            ("/restaurants/1/tickets/", list_create),
+            ("/restaurants/1/tickets/", list_create_update),
             ("/restaurants/1/tickets/1/", retrieve_update_destroy),
         )
 
@@ -316,6 +361,30 @@ class RestaurantsTests(TestCase):
 
         self.assertEqual(response_not_owner.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_tickets_list_cursor_pagination(self):
+        user1 = User.objects.get(username="test1")
+        restaurant1 = Restaurant.objects.create(owner=user1)
+        restaurant2 = Restaurant.objects.create(owner=user1)
+
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=restaurant)
+            for restaurant in [restaurant1, restaurant2] * 8
+        )
+
+        token1 = Token.objects.get(user=user1)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token1.key)
+
+        response = client.get("/restaurants/2/tickets/", {"pagination": "cursor"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data.get("next"))
+        self.assertEqual(
+            [ticket["id"] for ticket in response.data.get("results")],
+            list(range(2, 17, 2)),
+        )
+
     def test_ticket_create(self):
         user1 = User.objects.get(username="test1")
         user2 = User.objects.get(username="test2")
@@ -493,3 +562,1177 @@ class RestaurantsTests(TestCase):
         self.assertEqual(
             response_user1_wrong_path.status_code, status.HTTP_404_NOT_FOUND
         )
+
+
+class QueryCountTests(TestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test1", password="test1")
+        token = Token.objects.create(user=user)
+
+        for restaurant in Restaurant.objects.bulk_create(
+            Restaurant(owner=user, name=str(n)) for n in range(3)
+        ):
+            Ticket.objects.bulk_create(Ticket(restaurant=restaurant) for _ in range(4))
+
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+        # Warm the token cache, counts below are for an authenticated owner
+        self.client.get("/restaurants/")
+
+    def test_auth(self):
+        client = APIClient()
+
+        with self.assertNumQueries(2):
+            client.post("/signup/", {"username": "test2", "password": "test2"})
+
+        with self.assertNumQueries(2):
+            client.post("/login/", {"username": "test1", "password": "test1"})
+
+    def test_restaurants(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/restaurants/")
+
+        self.assertEqual(response.data.get("count"), 3)
+
+        with self.assertNumQueries(1):
+            self.client.post("/restaurants/", {"name": "a"})
+
+        with self.assertNumQueries(1):
+            self.client.get("/restaurants/1/")
+
+        with self.assertNumQueries(2):
+            self.client.patch("/restaurants/1/", {"name": "b"})
+
+        with self.assertNumQueries(3):
+            self.client.delete("/restaurants/4/")
+
+    def test_restaurant_stats(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/restaurants/?stats=true")
+
+        self.assertEqual(len(response.data["results"]), 3)
+
+        with self.assertNumQueries(1):
+            self.client.get("/restaurants/1/?stats=true")
+
+    def test_tickets(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/restaurants/1/tickets/")
+
+        self.assertEqual(response.data.get("count"), 4)
+
+        with self.assertNumQueries(2):
+            self.client.post("/restaurants/1/tickets/", {"name": "a"})
+
+        with self.assertNumQueries(2):
+            self.client.post("/restaurants/1/tickets/", [{"name": "b"}] * 3)
+
+        with self.assertNumQueries(1):
+            self.client.get("/restaurants/1/tickets/1/")
+
+        # One locking read and one CASE UPDATE, in a savepoint, whatever the
+        # number of tickets
+        with self.assertNumQueries(4):
+            self.client.patch(
+                "/restaurants/1/tickets/",
+                [{"id": 2, "name": "b"}, {"id": 3, "max_purchase_count": 5}],
+            )
+
+        with self.assertNumQueries(4):
+            self.client.patch(
+                "/restaurants/1/tickets/",
+                [{"id": pk, "name": "c"} for pk in range(1, 5)],
+            )
+
+        # The UPDATE is followed by a read of the purchase_count it kept.
+        with self.assertNumQueries(3):
+            self.client.patch("/restaurants/1/tickets/1/", {"name": "b"})
+
+        with self.assertNumQueries(2):
+            self.client.delete("/restaurants/1/tickets/1/")
+
+    @override_settings(REQUEST_METRICS={"INTERNAL_NETWORKS": ["127.0.0.0/8"]})
+    def test_metrics(self):
+        with self.assertNumQueries(0):
+            response = APIClient().get("/metrics/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_empty_tickets(self):
+        restaurant = Restaurant.objects.create(owner=User.objects.get(username="test1"))
+
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/restaurants/{restaurant.pk}/tickets/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get("count"), 0)
+
+
+class BulkTicketCreateTests(TestCase):
+    def setUp(self) -> None:
+        owner = User.objects.create_user("test1", password="test1")
+        other = User.objects.create_user("test2", password="test2")
+        Restaurant.objects.create(owner=owner)
+        self.endpoint = "/restaurants/1/tickets/"
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=owner).key
+        )
+        self.other_client = APIClient()
+        self.other_client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=other).key
+        )
+
+    def test_bulk_create(self):
+        response = self.client.post(
+            self.endpoint,
+            [
+                {"name": "a"},
+                {"name": "b", "max_purchase_count": 5, "purchase_count": 2},
+            ],
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            response.data,
+            [
+                {"id": 1, "name": "a", "max_purchase_count": 0, "purchase_count": 0},
+                {"id": 2, "name": "b", "max_purchase_count": 5, "purchase_count": 2},
+            ],
+        )
+        self.assertEqual(self.client.get(self.endpoint).data["results"], response.data)
+        self.assertIsNotNone(Ticket.objects.get(pk=2).updated_at)
+
+    def test_bulk_create_is_validated_as_a_whole(self):
+        response = self.client.post(
+            self.endpoint,
+            [
+                {"name": "a"},
+                {"name": []},
+                {"name": "c", "purchase_count": 1},
+                "d",
+            ],
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = response.json()
+        self.assertEqual(list(errors), ["1", "2", "3"])
+        self.assertIn("name", errors["1"])
+        self.assertIn("purchase_count", errors["2"])
+        self.assertIn("non_field_errors", errors["3"])
+        self.assertFalse(Ticket.objects.exists())
+
+        response_empty = self.client.post(self.endpoint, [])
+
+        self.assertEqual(response_empty.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with mock.patch.object(RestaurantTicketViewSet, "bulk_create_max_items", 2):
+            response_too_many = self.client.post(self.endpoint, [{"name": "a"}] * 3)
+
+        self.assertEqual(response_too_many.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_create_not_owner(self):
+        response = self.other_client.post(self.endpoint, [{"name": "a"}])
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_bulk_create_in_batches(self):
+        with mock.patch.object(RestaurantTicketViewSet, "bulk_create_batch_size", 2):
+            response = self.client.post(
+                self.endpoint, [{"name": str(n)} for n in range(5)]
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([ticket["id"] for ticket in response.data], [1, 2, 3, 4, 5])
+        self.assertEqual(Ticket.objects.count(), 5)
+
+    def test_public_list_is_invalidated(self):
+        self.assertEqual(APIClient().get("/tickets/").data["count"], 0)
+
+        self.client.post(self.endpoint, [{"name": "a"}, {"name": "b"}])
+
+        self.assertEqual(APIClient().get("/tickets/").data["count"], 2)
+
+
+class BulkTicketUpdateTests(TestCase):
+    def setUp(self) -> None:
+        owner = User.objects.create_user("test1", password="test1")
+        other = User.objects.create_user("test2", password="test2")
+        restaurant = Restaurant.objects.create(owner=owner)
+        other_restaurant = Restaurant.objects.create(owner=other)
+        Ticket.objects.bulk_create(
+            [
+                Ticket(restaurant=restaurant, name="a", max_purchase_count=10),
+                Ticket(
+                    restaurant=restaurant,
+                    name="b",
+                    max_purchase_count=10,
+                    purchase_count=6,
+                ),
+                Ticket(restaurant=other_restaurant, name="c", max_purchase_count=10),
+            ]
+        )
+        self.endpoint = "/restaurants/1/tickets/"
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=owner).key
+        )
+        self.other_client = APIClient()
+        self.other_client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=other).key
+        )
+
+    def test_bulk_update(self):
+        response = self.client.patch(
+            self.endpoint,
+            [
+                {"id": 1, "name": "x", "max_purchase_count": 20},
+                {"id": 2, "max_purchase_count": 5},
+                {"id": 3, "name": "y"},
+                {"id": 4, "name": "z"},
+            ],
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "status": "updated",
+                    "id": 1,
+                    "name": "x",
+                    "max_purchase_count": 20,
+                    "purchase_count": 0,
+                },
+                {
+                    "status": "rejected",
+                    "id": 2,
+                    "errors": {
+                        "max_purchase_count": [
+                            "Cannot be less than purchase_count (6)."
+                        ]
+                    },
+                },
+                {"status": "not_found", "id": 3},
+                {"status": "not_found", "id": 4},
+            ],
+        )
+        self.assertEqual(
+            list(
+                Ticket.objects.order_by("id").values_list("name", "max_purchase_count")
+            ),
+            [("x", 20), ("b", 10), ("c", 10)],
+        )
+
+    def test_bulk_update_in_batches(self):
+        Ticket.objects.filter(pk=2).update(purchase_count=0)
+
+        with mock.patch.object(RestaurantTicketViewSet, "bulk_update_batch_size", 1):
+            with self.assertNumQueries(6):
+                response = self.client.patch(
+                    self.endpoint,
+                    [{"id": 1, "name": "x"}, {"id": 2, "max_purchase_count": 0}],
+                )
+
+        self.assertEqual(
+            [item["status"] for item in response.data], ["updated", "updated"]
+        )
+        self.assertEqual(
+            list(
+                Ticket.objects.order_by("id").values_list("name", "max_purchase_count")
+            ),
+            [("x", 10), ("b", 0), ("c", 10)],
+        )
+
+    def test_invariant_is_enforced_by_the_update(self):
+        # A purchase committed after the tickets were read still blocks the
+        # lower max_purchase_count, and is reported like any other rejection.
+        in_bulk = TicketQuerySet.in_bulk
+        purchased = []
+
+        def in_bulk_then_purchase(queryset, *args, **kwargs):
+            tickets = in_bulk(queryset, *args, **kwargs)
+            if not purchased:
+                purchased.append(Ticket.objects.filter(pk=1).update(purchase_count=8))
+            return tickets
+
+        with mock.patch(
+            "app_restaurants.models.TicketQuerySet.in_bulk", in_bulk_then_purchase
+        ):
+            response = self.client.patch(
+                self.endpoint,
+                [{"id": 1, "max_purchase_count": 7}, {"id": 2, "name": "x"}],
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()[0],
+            {
+                "status": "rejected",
+                "id": 1,
+                "errors": {
+                    "max_purchase_count": ["Cannot be less than purchase_count (8)."]
+                },
+            },
+        )
+        self.assertEqual(response.json()[1]["status"], "updated")
+        self.assertEqual(response.json()[1]["name"], "x")
+        ticket = Ticket.objects.get(pk=1)
+        self.assertEqual(ticket.max_purchase_count, 10)
+        self.assertEqual(ticket.version, 0)
+        self.assertEqual(Ticket.objects.get(pk=2).version, 1)
+
+    def test_bulk_update_is_validated_as_a_whole(self):
+        response = self.client.patch(
+            self.endpoint,
+            [{"id": 1, "name": "x"}, {"max_purchase_count": 1}, {"id": 1}],
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response.json()), ["1"])
+
+        response_duplicate = self.client.patch(
+            self.endpoint, [{"id": 1, "name": "x"}, {"id": 1, "name": "y"}]
+        )
+
+        self.assertEqual(response_duplicate.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(response_duplicate.json()), ["1"])
+        self.assertEqual(Ticket.objects.get(pk=1).name, "a")
+
+    def test_bulk_update_not_owner(self):
+        response = self.other_client.patch(self.endpoint, [{"id": 1, "name": "x"}])
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(Ticket.objects.get(pk=1).name, "a")
+
+    def test_public_ticket_is_invalidated(self):
+        self.assertEqual(APIClient().get("/tickets/1/").data["name"], "a")
+
+        self.client.patch(self.endpoint, [{"id": 1, "name": "x"}])
+
+        self.assertEqual(APIClient().get("/tickets/1/").data["name"], "x")
+
+
+class TicketVersionTests(TestCase):
+    def setUp(self) -> None:
+        owner = User.objects.create_user("test1", password="test1")
+        restaurant = Restaurant.objects.create(owner=owner)
+        self.ticket = Ticket.objects.create(
+            restaurant=restaurant, name="a", max_purchase_count=10
+        )
+        self.endpoint = f"/restaurants/1/tickets/{self.ticket.pk}/"
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=owner).key
+        )
+
+    def concurrently(self, change):
+        get_object = RestaurantTicketViewSet.get_object
+
+        def get_object_then_change(view):
+            ticket = get_object(view)
+            change(ticket)
+            return ticket
+
+        return mock.patch.object(
+            RestaurantTicketViewSet, "get_object", get_object_then_change
+        )
+
+    def test_etag(self):
+        response = self.client.get(self.endpoint)
+
+        self.assertEqual(response["ETag"], 'W/"0"')
+
+        response_update = self.client.patch(
+            self.endpoint, {"name": "b"}, HTTP_IF_MATCH='"0"'
+        )
+
+        self.assertEqual(response_update.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_update["ETag"], 'W/"1"')
+        self.assertEqual(self.client.get(self.endpoint)["ETag"], 'W/"1"')
+
+        Ticket.objects.purchase(self.ticket.pk, 1)
+
+        self.assertEqual(self.client.get(self.endpoint)["ETag"], 'W/"1"')
+
+    def test_stale_if_match(self):
+        self.client.patch(self.endpoint, {"name": "b"})
+
+        response = self.client.patch(self.endpoint, {"name": "c"}, HTTP_IF_MATCH='"0"')
+
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Ticket.objects.get().name, "b")
+
+        response_any = self.client.patch(
+            self.endpoint, {"name": "c"}, HTTP_IF_MATCH="*"
+        )
+
+        self.assertEqual(response_any.status_code, status.HTTP_200_OK)
+        self.assertEqual(Ticket.objects.get().name, "c")
+
+    def test_concurrent_owner_edit(self):
+        with self.concurrently(
+            lambda ticket: Ticket.objects.update_versioned(ticket.pk, {"name": "b"})
+        ):
+            response = self.client.patch(
+                self.endpoint, {"name": "c"}, HTTP_IF_MATCH='"0"'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Ticket.objects.get().name, "b")
+
+        with self.concurrently(
+            lambda ticket: Ticket.objects.update_versioned(ticket.pk, {"name": "d"})
+        ):
+            response_unconditional = self.client.patch(self.endpoint, {"name": "c"})
+
+        self.assertEqual(response_unconditional.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_unconditional["ETag"], 'W/"3"')
+        self.assertEqual(Ticket.objects.get().name, "c")
+
+    def test_purchases_are_not_overwritten(self):
+        with self.concurrently(lambda ticket: Ticket.objects.purchase(ticket.pk, 3)):
+            response = self.client.patch(
+                self.endpoint, {"name": "b"}, HTTP_IF_MATCH='"0"'
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["purchase_count"], 3)
+        ticket = Ticket.objects.get()
+        self.assertEqual((ticket.name, ticket.purchase_count), ("b", 3))
+
+        with self.concurrently(lambda ticket: Ticket.objects.purchase(ticket.pk, 3)):
+            response_below_sold = self.client.patch(
+                self.endpoint, {"max_purchase_count": 5}
+            )
+
+        self.assertEqual(response_below_sold.status_code, status.HTTP_400_BAD_REQUEST)
+        ticket = Ticket.objects.get()
+        self.assertEqual((ticket.max_purchase_count, ticket.purchase_count), (10, 6))
+
+    def test_delete_if_match(self):
+        self.client.patch(self.endpoint, {"name": "b"})
+
+        response = self.client.delete(self.endpoint, HTTP_IF_MATCH='"0"')
+
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertTrue(Ticket.objects.exists())
+
+        response_current = self.client.delete(self.endpoint, HTTP_IF_MATCH='"1"')
+
+        self.assertEqual(response_current.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_bulk_update_bumps_version(self):
+        self.client.patch("/restaurants/1/tickets/", [{"id": self.ticket.pk}])
+
+        self.assertEqual(self.client.get(self.endpoint)["ETag"], 'W/"1"')
+
+
+class RestaurantStatsTests(TestCase):
+    def setUp(self) -> None:
+        owner = User.objects.create_user("test1", password="test1")
+        restaurant = Restaurant.objects.create(owner=owner, name="a")
+        Restaurant.objects.create(owner=owner, name="b")
+        Ticket.objects.bulk_create(
+            [
+                Ticket(restaurant=restaurant, max_purchase_count=10, purchase_count=4),
+                Ticket(restaurant=restaurant, max_purchase_count=5, purchase_count=5),
+            ]
+        )
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=owner).key
+        )
+
+    def test_stats(self):
+        response = self.client.get("/restaurants/?stats=true")
+        results = response.data["results"]
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            results,
+            [
+                {
+                    "id": 1,
+                    "name": "a",
+                    "ticket_count": 2,
+                    "total_sold": 9,
+                    "total_capacity": 15,
+                    "total_remaining": 6,
+                },
+                {
+                    "id": 2,
+                    "name": "b",
+                    "ticket_count": 0,
+                    "total_sold": 0,
+                    "total_capacity": 0,
+                    "total_remaining": 0,
+                },
+            ],
+        )
+
+        response_detail = self.client.get("/restaurants/1/?stats=true")
+
+        self.assertEqual(response_detail.data, results[0])
+
+    def test_stats_are_optional(self):
+        response = self.client.get("/restaurants/1/")
+
+        self.assertEqual(response.data, {"id": 1, "name": "a"})
+
+        response_invalid = self.client.get("/restaurants/?stats=yes")
+
+        self.assertEqual(response_invalid.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response_update = self.client.patch("/restaurants/1/?stats=true", {"name": "c"})
+
+        self.assertEqual(response_update.data, {"id": 1, "name": "c"})
+
+
+class ValuesListTests(TestCase):
+    def test_matches_serializer_output(self):
+        user = User.objects.create_user("test1", password="test1")
+        token = Token.objects.create(user=user)
+        restaurant = Restaurant.objects.create(owner=user, name='r "1" ✓')
+        Ticket.objects.create(
+            restaurant=restaurant, name="ü", max_purchase_count=5, purchase_count=2
+        )
+
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+        for endpoint in (
+            "/restaurants/",
+            "/restaurants/?stats=true",
+            "/restaurants/1/tickets/",
+        ):
+            fast = client.get(endpoint).content
+
+            with mock.patch.object(ValuesListMixin, "list", ListModelMixin.list):
+                serialized = client.get(endpoint).content
+
+            self.assertEqual(fast, serialized)
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user("test1", password="test1")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    def test_token_lookup_is_cached(self):
+        with self.assertNumQueries(2):
+            self.client.get("/restaurants/")
+
+        with self.assertNumQueries(1):
+            self.client.get("/restaurants/")
+
+    def test_deleted_token_is_rejected(self):
+        self.client.get("/restaurants/")
+        self.token.delete()
+
+        response = self.client.get("/restaurants/")
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_inactive_user_is_rejected(self):
+        self.client.get("/restaurants/")
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get("/restaurants/")
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_cached_user_has_no_password(self):
+        self.client.get("/restaurants/")
+
+        entry = token_cache().get(token_cache_key(self.token.key))
+        user, token = CachedTokenAuthentication().authenticate_credentials(
+            self.token.key
+        )
+
+        self.assertNotIn(self.user.password, repr(entry))
+        self.assertEqual((user.pk, user.username), (self.user.pk, "test1"))
+        self.assertEqual((token.key, token.user), (self.token.key, user))
+        self.assertIn("password", user.get_deferred_fields())
+
+    def test_saving_user_without_tokens(self):
+        # Redis rejects a DEL without keys.
+        user = User.objects.create_user("test2", password="test2")
+
+        with mock.patch.object(token_cache(), "delete_many") as delete_many:
+            user.save()
+
+        delete_many.assert_not_called()
+
+    def test_shared_cache_check(self):
+        with override_settings(CACHES=settings.CACHE_PROFILES["local"]):
+            self.assertEqual(
+                [error.id for error in checks.check_shared_caches(None)],
+                ["app_restaurants.E001"],
+            )
+
+        with override_settings(CACHES=settings.CACHE_PROFILES["redis"]):
+            self.assertEqual(checks.check_shared_caches(None), [])
+
+
+@override_settings(ROOT_URLCONF="restaurants_test.asgi_urls")
+class AsyncAuthorizationTests(TransactionTestCase):
+    # authenticate() and create_user() run on the hashing pool's threads, with
+    # their own connections, which only see committed rows.
+    async def test_signup(self):
+        client = AsyncClient()
+        endpoint = "/signup/"
+
+        response = await client.post(
+            endpoint, {"username": "test", "password": "test"}, "application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIsNotNone(response.json().get("token"))
+
+        response_existent = await client.post(
+            endpoint, {"username": "test", "password": "test"}, "application/json"
+        )
+
+        self.assertEqual(response_existent.status_code, status.HTTP_403_FORBIDDEN)
+
+        response_empty_body = await client.post(endpoint, {}, "application/json")
+
+        self.assertEqual(response_empty_body.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response_empty_username = await client.post(
+            endpoint, {"username": "", "password": "test"}, "application/json"
+        )
+
+        self.assertEqual(
+            response_empty_username.status_code, status.HTTP_400_BAD_REQUEST
+        )
+        self.assertEqual(await User.objects.acount(), 1)
+
+    async def test_login(self):
+        await User.objects.acreate(username="test", password=make_password("test"))
+
+        client = AsyncClient()
+        endpoint = "/login/"
+
+        response = await client.post(endpoint, {"username": "test", "password": "test"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.json().get("token"))
+
+        response_wrong_password = await client.post(
+            endpoint, {"username": "test", "password": "test1"}
+        )
+
+        self.assertEqual(response_wrong_password.status_code, status.HTTP_404_NOT_FOUND)
+
+        response_non_existent = await client.post(
+            endpoint, {"username": "test1", "password": "test1"}
+        )
+
+        self.assertEqual(response_non_existent.status_code, status.HTTP_404_NOT_FOUND)
+
+        response_empty_body = await client.post(endpoint, {})
+
+        self.assertEqual(response_empty_body.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_login_authenticates(self):
+        hasher = PBKDF2PasswordHasher()
+        await User.objects.acreate(
+            username="test",
+            password=hasher.encode("test", hasher.salt(), iterations=1),
+        )
+        await User.objects.acreate(
+            username="inactive", password=make_password("test"), is_active=False
+        )
+        failed = mock.Mock()
+        user_login_failed.connect(failed)
+        self.addCleanup(user_login_failed.disconnect, failed)
+        client = AsyncClient()
+
+        response = await client.post("/login/", {"username": "test", "password": "x"})
+        response_inactive = await client.post(
+            "/login/", {"username": "inactive", "password": "test"}
+        )
+        response_rehashed = await client.post(
+            "/login/", {"username": "test", "password": "test"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(response_inactive.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(failed.call_count, 2)
+        self.assertEqual(response_rehashed.status_code, status.HTTP_200_OK)
+        # Hashed again with the current iterations, like a sync login does.
+        user = await User.objects.aget(username="test")
+        self.assertFalse(user.password.startswith("pbkdf2_sha256$1$"))
+
+    async def test_saturated_pool(self):
+        pool = HashingPool(max_workers=1, max_queue=0)
+        release = threading.Event()
+
+        running = asyncio.ensure_future(pool.run(release.wait))
+        await asyncio.sleep(0)
+
+        with mock.patch.object(async_views, "hashing_pool", pool):
+            response = await AsyncClient().post(
+                "/login/", {"username": "test", "password": "test"}
+            )
+
+        release.set()
+        await running
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.headers.get("Retry-After"), "1")
+
+
+class SQLitePragmaTests(TestCase):
+    @override_settings(
+        SQLITE_PRAGMAS={"journal_mode": "wal", "synchronous": 1, "busy_timeout": 1000}
+    )
+    def test_pragmas_applied_on_connect(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = SQLiteDatabaseWrapper(
+                dict(
+                    connection.settings_dict,
+                    ENGINE="django.db.backends.sqlite3",
+                    NAME=os.path.join(directory, "db.sqlite3"),
+                ),
+                alias="pragmas",
+            )
+            try:
+                with database.cursor() as cursor:
+                    pragmas = {
+                        name: cursor.execute(f"PRAGMA {name}").fetchone()[0]
+                        for name in ("journal_mode", "synchronous", "busy_timeout")
+                    }
+            finally:
+                database.close()
+
+        self.assertEqual(
+            pragmas, {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 1000}
+        )
+
+
+@skipUnless(connection.vendor == "sqlite", "Query plans are checked on SQLite")
+class IndexUsageTests(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user("test", password="test")
+        self.restaurant = Restaurant.objects.create(owner=self.user)
+
+    def list_queryset(self, view_class, params=None, **kwargs):
+        """The first page query of the view's list action."""
+        request = Request(APIRequestFactory().get("/", params))
+        request.user = self.user
+        view = view_class(
+            request=request, format_kwarg=None, args=(), kwargs=kwargs, action="list"
+        )
+        queryset = view.filter_queryset(view.get_queryset())
+        return queryset.values(*view.list_fields.values())[:10]
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertIn(f"USING INDEX {index}", plan.replace("COVERING ", ""))
+
+    def test_owner_restaurants(self):
+        self.assertUsesIndex(
+            self.list_queryset(RestaurantViewSet), "restaurant_owner_id_idx"
+        )
+
+    def test_restaurant_tickets(self):
+        self.assertUsesIndex(
+            self.list_queryset(
+                RestaurantTicketViewSet, restaurant_pk=self.restaurant.pk
+            ),
+            "ticket_restaurant_id_idx",
+        )
+
+    def test_available_tickets(self):
+        self.assertUsesIndex(
+            self.list_queryset(PublicTicketList, {"available": "true"}),
+            "ticket_available_idx",
+        )
+
+    def test_tickets_by_purchase_left(self):
+        for params in (
+            {"ordering": "-purchase_left"},
+            {"ordering": "purchase_left", "min_left": 5},
+        ):
+            self.assertUsesIndex(
+                self.list_queryset(PublicTicketList, params),
+                "ticket_purchase_left_idx",
+            )
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user("test", password="test", is_staff=True)
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        other = User.objects.create_user("other", password="other")
+        self.other_client = APIClient()
+        self.other_client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=other).key
+        )
+        patcher = mock.patch.object(metrics, "request_metrics", RequestMetrics())
+        self.request_metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_server_timing(self):
+        response = self.client.post("/restaurants/", {"name": "a"})
+
+        self.assertRegex(
+            response["Server-Timing"],
+            r'^db;dur=\d+\.\d\d;desc="2 queries", total;dur=\d+\.\d\d$',
+        )
+
+        response_other = self.other_client.post("/restaurants/", {"name": "a"})
+
+        self.assertEqual(response_other.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Server-Timing", response_other)
+
+    @override_settings(REQUEST_METRICS={"INTERNAL_NETWORKS": ["127.0.0.0/8"]})
+    def test_internal_network(self):
+        response = APIClient().get("/tickets/")
+
+        self.assertIn("Server-Timing", response)
+        self.assertEqual(APIClient().get("/metrics/").status_code, status.HTTP_200_OK)
+
+        response_external = APIClient(REMOTE_ADDR="192.0.2.1").get("/tickets/")
+
+        self.assertNotIn("Server-Timing", response_external)
+        self.assertEqual(
+            APIClient(REMOTE_ADDR="192.0.2.1").get("/metrics/").status_code,
+            status.HTTP_401_UNAUTHORIZED,
+        )
+
+    def test_metrics_endpoint(self):
+        self.client.get("/restaurants/")
+        self.client.get("/restaurants/")
+        self.client.post("/restaurants/", {"name": "a"})
+
+        response = self.client.get("/metrics/")
+        body = response.content.decode()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4")
+        self.assertIn("# TYPE http_request_duration_seconds histogram", body)
+        self.assertIn(
+            'http_request_duration_seconds_count{view="RestaurantViewSet.list",'
+            'method="GET"} 2',
+            body,
+        )
+        self.assertIn(
+            'http_request_db_queries_bucket{view="RestaurantViewSet.create",'
+            'method="POST",le="0"} 0',
+            body,
+        )
+        self.assertIn(
+            'http_request_db_queries_bucket{view="RestaurantViewSet.create",'
+            'method="POST",le="1"} 1',
+            body,
+        )
+
+    def test_metrics_endpoint_is_for_staff(self):
+        self.assertEqual(
+            self.other_client.get("/metrics/").status_code, status.HTTP_403_FORBIDDEN
+        )
+        self.assertEqual(
+            APIClient().get("/metrics/").status_code, status.HTTP_401_UNAUTHORIZED
+        )
+
+    def test_labels(self):
+        self.request_metrics.observe('a"b\\c\nd', "PURGE", 0.001, metrics.QueryStats())
+        body = self.request_metrics.render()
+
+        self.assertIn(
+            'http_request_db_queries_count{view="a\\"b\\\\c\\nd",method="other"} 1',
+            body,
+        )
+
+    @override_settings(REQUEST_METRICS={"ENABLED": False})
+    def test_disabled(self):
+        response = APIClient().get("/tickets/")
+
+        self.assertNotIn("Server-Timing", response)
+
+
+class AsyncRequestMetricsTests(TransactionTestCase):
+    # The async ticket views read on executor threads with their own
+    # connections, which only see committed rows.
+    def setUp(self) -> None:
+        self.addCleanup(close_thread_connections)
+        patcher = mock.patch.object(metrics, "request_metrics", RequestMetrics())
+        self.request_metrics = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(
+        ROOT_URLCONF="restaurants_test.asgi_urls",
+        REQUEST_METRICS={"INTERNAL_NETWORKS": ["127.0.0.0/8"]},
+    )
+    def test_async_view(self):
+        caches[settings.TICKET_CACHE_ALIAS].clear()
+        user = User.objects.create_user("test", password="test")
+        Ticket.objects.create(restaurant=Restaurant.objects.create(owner=user))
+
+        response = async_to_sync(AsyncClient().get)("/tickets/")
+
+        self.assertIn('desc="2 queries"', response["Server-Timing"])
+        self.assertIn(
+            'http_request_db_queries_count{view="ticket_list",method="GET"} 1',
+            self.request_metrics.render(),
+        )
+
+
+PROFILING = {
+    "SAMPLE_RATE": 0,
+    "TOP_FUNCTIONS": 5,
+    "SLOW_REQUEST_THRESHOLD": 60,
+    "SLOW_REQUEST_LOG_SIZE": 3,
+    "CACHE_ALIAS": "default",
+}
+
+
+@override_settings(REQUEST_PROFILING=PROFILING)
+class RequestProfilingTests(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user("test", password="test")
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        self.log = SlowRequestLog.from_settings(PROFILING)
+        self.log.clear()
+
+    def dump(self):
+        out = StringIO()
+        call_command("slow_requests", stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_profile_token(self):
+        response = self.client.get(
+            "/restaurants/", HTTP_X_PROFILE_TOKEN=profiling_token()
+        )
+        (record,) = self.dump()
+
+        self.assertEqual(response["X-Profile-Id"], record["id"])
+        self.assertEqual(record["view"], "RestaurantViewSet.list")
+        self.assertEqual(record["status"], status.HTTP_200_OK)
+        self.assertTrue(record["profiled"])
+        self.assertEqual(len(record["functions"]), 5)
+        self.assertEqual(len(record["queries"]), 2)
+        self.assertIn("app_restaurants_restaurant", record["queries"][1]["sql"])
+
+    def test_bad_profile_token(self):
+        response = self.client.get("/restaurants/", HTTP_X_PROFILE_TOKEN="bad")
+
+        self.assertNotIn("X-Profile-Id", response)
+        self.assertEqual(self.dump(), [])
+
+    @override_settings(REQUEST_PROFILING=dict(PROFILING, SAMPLE_RATE=1))
+    def test_sampling(self):
+        response = self.client.get("/restaurants/")
+
+        self.assertIn("X-Profile-Id", response)
+
+    @override_settings(REQUEST_PROFILING=dict(PROFILING, SLOW_REQUEST_THRESHOLD=0))
+    def test_slow_request_log(self):
+        for _ in range(4):
+            self.client.get("/restaurants/")
+        self.client.get("/tickets/", {"page": 1})
+
+        records = self.dump()
+
+        self.assertEqual([record["seq"] for record in records], [3, 4, 5])
+        self.assertEqual(records[-1]["path"], "/tickets/?page=1")
+        self.assertFalse(records[-1]["profiled"])
+        self.assertNotIn("functions", records[-1])
+
+        call_command("slow_requests", "--clear", stdout=StringIO())
+
+        self.assertEqual(self.dump(), [])
+
+    @override_settings(
+        ROOT_URLCONF="restaurants_test.asgi_urls",
+        REQUEST_PROFILING=dict(PROFILING, SLOW_REQUEST_THRESHOLD=0),
+    )
+    def test_async_requests_are_logged_off_the_event_loop(self):
+        append = SlowRequestLog.append
+        loops = []
+
+        def append_outside_loop(log, record):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            append(log, record)
+
+        with mock.patch.object(SlowRequestLog, "append", append_outside_loop):
+            async_to_sync(AsyncClient().get)("/tickets/")
+
+        self.assertEqual(loops, [None])
+        self.assertEqual(self.dump()[0]["view"], "ticket_list")
+
+    def test_locking_file_based_cache(self):
+        with tempfile.TemporaryDirectory() as location:
+            cache = LockingFileBasedCache(location, {})
+            cache.add("next", 0)
+
+            def increment():
+                for _ in range(50):
+                    cache.incr("next")
+
+            threads = [threading.Thread(target=increment) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(cache.get("next"), 400)
+
+
+class PurchaseLedgerTests(TestCase):
+    def setUp(self) -> None:
+        owner = User.objects.create_user("test1", password="test1")
+        self.restaurant = Restaurant.objects.create(owner=owner)
+        self.ticket = Ticket.objects.create(
+            restaurant=self.restaurant, max_purchase_count=10
+        )
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=owner).key
+        )
+
+    def ledger(self, ticket=None):
+        ticket = ticket or self.ticket
+        return list(ticket.purchases.order_by("id").values_list("amount", flat=True))
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command("reconcile_purchases", *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_purchases_are_recorded(self):
+        Ticket.objects.purchase(self.ticket.pk, 2)
+        Ticket.objects.purchase(self.ticket.pk, 20)
+        Ticket.objects.purchase_many(self.ticket.pk, [1, 1])
+        Ticket.objects.purchase_many(self.ticket.pk, [9, -1, 1])
+
+        self.assertEqual(self.ledger(), [2, 1, 1, -1, 1])
+        self.assertEqual(Ticket.objects.get().purchase_count, 4)
+
+    def test_purchase_batch(self):
+        other = Ticket.objects.create(restaurant=self.restaurant, max_purchase_count=1)
+
+        tickets = Ticket.objects.purchase_batch(
+            [(self.ticket.pk, 2), (other.pk, 1), (other.pk, 1), (self.ticket.pk, 1)]
+        )
+
+        self.assertEqual(
+            [ticket and ticket.purchase_count for ticket in tickets], [2, 1, None]
+        )
+        self.assertEqual(self.ledger(), [2])
+        self.assertEqual(self.ledger(other), [1])
+
+    def test_history_outlives_the_ticket(self):
+        Ticket.objects.purchase(self.ticket.pk, 2)
+
+        response = self.client.delete(f"/restaurants/1/tickets/{self.ticket.pk}/")
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(
+            list(
+                TicketPurchase.objects.filter(ticket_id=self.ticket.pk).values_list(
+                    "amount", flat=True
+                )
+            ),
+            [2],
+        )
+        self.assertIn("Checked 0 tickets", self.reconcile())
+
+    def test_owner_counts_are_recorded(self):
+        response = self.client.post(
+            "/restaurants/1/tickets/",
+            {"name": "a", "max_purchase_count": 5, "purchase_count": 3},
+        )
+        response_bulk = self.client.post(
+            "/restaurants/1/tickets/",
+            [
+                {"name": "b", "max_purchase_count": 5, "purchase_count": 4},
+                {"name": "c"},
+            ],
+        )
+        response_update = self.client.patch(
+            "/restaurants/1/tickets/2/", {"purchase_count": 1}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response_bulk.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response_update.status_code, status.HTTP_200_OK)
+
+        self.assertEqual(self.ledger(Ticket.objects.get(pk=2)), [3, -2])
+        self.assertEqual(self.ledger(Ticket.objects.get(pk=3)), [4])
+        self.assertEqual(self.ledger(Ticket.objects.get(pk=4)), [])
+        self.assertIn("0 did not match", self.reconcile())
+
+    def test_saved_counts_are_recorded(self):
+        ticket = Ticket.objects.get()
+        ticket.purchase_count = 4
+        ticket.save()
+        ticket.name = "a"
+        ticket.save()
+        Ticket.objects.purchase(ticket.pk, 1)
+        # The change is taken from the stored count, not the instance's.
+        ticket.purchase_count = 2
+        ticket.save()
+        ticket.purchase_count = 7
+        ticket.save(update_fields=["name"])
+
+        self.assertEqual(self.ledger(), [4, 1, -3])
+        self.assertIn("0 did not match", self.reconcile())
+
+    def test_reconcile(self):
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=self.restaurant, max_purchase_count=10) for _ in range(4)
+        )
+        for pk in (1, 3, 5):
+            Ticket.objects.purchase(pk, pk)
+
+        self.assertEqual(
+            self.reconcile("--chunk-size", "2"),
+            "Checked 5 tickets, 0 did not match the ledger.\n",
+        )
+
+        Ticket.objects.filter(pk__in=[2, 3]).update(purchase_count=7)
+
+        with self.assertRaisesMessage(CommandError, "2 tickets do not match"):
+            self.reconcile("--chunk-size", "2")
+
+        output = self.reconcile("--chunk-size", "2", "--fix")
+
+        self.assertIn("Ticket 2: purchase_count 7, ledger 0", output)
+        self.assertIn("Ticket 3: purchase_count 7, ledger 3", output)
+        self.assertEqual(
+            list(
+                Ticket.objects.order_by("id").values_list("purchase_count", flat=True)
+            ),
+            [1, 0, 3, 0, 5],
+        )
+        self.assertIn("0 did not match", self.reconcile())
+
+    def test_reconcile_keeps_counts_the_ledger_cannot_explain(self):
+        TicketPurchase.objects.create(ticket=self.ticket, amount=11)
+
+        with self.assertRaisesMessage(CommandError, "1 tickets do not match"):
+            self.reconcile("--fix")
+
+        self.assertEqual(Ticket.objects.get().purchase_count, 0)
@@ -1,12 +1,28 @@
 from django.urls import include, path
 from rest_framework_nested import routers
 
+from .metrics import metrics
 from .views import RestaurantTicketViewSet, RestaurantViewSet, login, signup
 
+
+class BulkNestedRouter(routers.NestedSimpleRouter):
+    """Also routes PATCH on a list URL to the viewset's `bulk_partial_update`."""
+
+    routes = [
+        routers.SimpleRouter.routes[0]._replace(
+            mapping={
+                **routers.SimpleRouter.routes[0].mapping,
+                "patch": "bulk_partial_update",
+            }
+        ),
+        *routers.SimpleRouter.routes[1:],
+    ]
+
+
 router = routers.SimpleRouter()
 router.register(r"restaurants", RestaurantViewSet, basename="restaurant")
 
-tickets_router = routers.NestedSimpleRouter(router, r"restaurants", lookup="restaurant")
+tickets_router = BulkNestedRouter(router, r"restaurants", lookup="restaurant")
 tickets_router.register(
     r"tickets",
     RestaurantTicketViewSet,
@@ -19,4 +35,6 @@ urlpatterns = [
     # Auth
     path("signup/", signup),
     path("login/", login),
+    # Monitoring
+    path("metrics/", metrics),
 ]
@@ -1,15 +1,55 @@
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import permissions, status, viewsets
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view
-from rest_framework.exceptions import NotFound, ParseError, PermissionDenied
+from rest_framework.exceptions import (
+    APIException,
+    NotFound,
+    ParseError,
+    PermissionDenied,
+)
 from rest_framework.response import Response
 
+from .mixins import ValuesListMixin
 from .models import Restaurant, Ticket
-from .serializers import RestaurantSerializer, TicketSerializer
+from .pagination import TicketPagination
+from .serializers import (
+    RestaurantSerializer,
+    RestaurantStatsSerializer,
+    TicketBulkUpdateSerializer,
+    TicketCreateSerializer,
+    TicketSerializer,
+)
+from .signals import tickets_bulk_saved
+
+
+class PreconditionFailed(APIException):
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = "The ticket has changed, fetch it again before retrying."
+    default_code = "precondition_failed"
+
+
+def ticket_etag(ticket):
+    # Versions the fields owners edit. It is weak because the representation
+    # also has purchase_count, which purchases change without a new version.
+    return "W/" + quote_etag(str(ticket.version))
+
+
+def weak_etag_match(etag, etags):
+    """The weak comparison of RFC 9110 section 8.8.3.2."""
+    return etag.removeprefix("W/") in (tag.removeprefix("W/") for tag in etags)
+
+
+def bulk_errors(serializer):
+    """Errors of a `many=True` serializer, keyed by the index of each bad item."""
+    errors = serializer.errors
+    if isinstance(errors, list):
+        errors = {index: error for index, error in enumerate(errors) if error}
+    return errors
 
 
 @api_view(["POST"])
@@ -29,7 +69,7 @@ def signup(request):
             },
             status.HTTP_403_FORBIDDEN,
         )
-    except (ParseError, KeyError):
+    except (ParseError, KeyError, ValueError):
         return Response(
             {"error": "Could not signup. Please check username and password"},
             status.HTTP_400_BAD_REQUEST,
@@ -63,52 +103,264 @@ def login(request):
         return Response({"token": str(token)}, status.HTTP_200_OK)
 
 
-class RestaurantViewSet(viewsets.ModelViewSet):
+class RestaurantViewSet(ValuesListMixin, viewsets.ModelViewSet):
+    """
+    Restaurants of the user. `?stats=true` on list and retrieve adds ticket
+    stats, computed in the same query.
+    """
+
     serializer_class = RestaurantSerializer
     permission_classes = [permissions.IsAuthenticated]
+    stats_fields = {
+        "ticket_count": "ticket_count",
+        "total_sold": "total_sold",
+        "total_capacity": "total_capacity",
+        "total_remaining": "total_remaining",
+    }
+
+    with_stats = False
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.action in ("list", "retrieve"):
+            stats = request.query_params.get("stats", "false")
+            if stats not in ("true", "false"):
+                raise ParseError('"stats" must be true or false')
+            self.with_stats = stats == "true"
+
+    @property
+    def list_fields(self):
+        fields = {"id": "id", "name": "name"}
+        if self.with_stats:
+            fields.update(self.stats_fields)
+        return fields
+
+    def get_serializer_class(self):
+        if self.with_stats:
+            return RestaurantStatsSerializer
+        return RestaurantSerializer
 
     def get_queryset(self):
+        queryset = Restaurant.objects.filter(owner=self.request.user).order_by("id")
         if self.kwargs.get("pk"):
-            return Restaurant.objects.filter(
-                owner=self.request.user, pk=self.kwargs["pk"]
-            )
-        return Restaurant.objects.filter(owner=self.request.user)
+            queryset = queryset.filter(pk=self.kwargs["pk"])
+        if self.with_stats:
+            queryset = queryset.with_ticket_stats()
+        return queryset
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
 
 
-class RestaurantTicketViewSet(viewsets.ModelViewSet):
+class RestaurantTicketViewSet(ValuesListMixin, viewsets.ModelViewSet):
     serializer_class = TicketSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = TicketPagination
+    list_fields = {
+        "id": "id",
+        "name": "name",
+        "max_purchase_count": "max_purchase_count",
+        "purchase_count": "purchase_count",
+    }
+    bulk_create_max_items = 10000
+    bulk_create_batch_size = 500
+    bulk_update_max_items = 10000
+    bulk_update_batch_size = 500
+
+    def owned_restaurant(self):
+        return Restaurant.objects.filter(
+            owner=self.request.user, pk=self.kwargs["restaurant_pk"]
+        )
 
     def get_queryset(self):
-        try:
-            restaurant = Restaurant.objects.get(
-                owner=self.request.user, pk=self.kwargs["restaurant_pk"]
-            )
-            if self.kwargs.get("pk"):
-                return Ticket.objects.filter(
-                    restaurant=restaurant,
-                    pk=self.kwargs["pk"],
-                )
-            return restaurant.tickets.all()
-        except ObjectDoesNotExist:
+        # Ownership is part of the ticket query, no separate lookup.
+        return Ticket.objects.filter(
+            restaurant=self.kwargs["restaurant_pk"],
+            restaurant__owner=self.request.user,
+        ).order_by("id")
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # An empty page is either a restaurant without tickets or one the
+        # user does not own.
+        if not page and not self.owned_restaurant().exists():
             raise NotFound
+        return page
 
     def perform_create(self, serializer):
+        if not self.owned_restaurant().exists():
+            raise PermissionDenied
         try:
-            restaurant = Restaurant.objects.get(
-                owner=self.request.user, pk=self.kwargs["restaurant_pk"]
+            serializer.save(restaurant_id=self.kwargs["restaurant_pk"])
+        except (IntegrityError, OverflowError):
+            raise ParseError
+
+    def check_if_match(self, ticket):
+        """
+        Raise PreconditionFailed if the request's If-Match does not match the
+        ticket's ETag. Returns whether the request was conditional.
+
+        The comparison is weak, so a purchase since the ticket was read does
+        not fail the precondition: owner edits keep purchases anyway.
+        """
+        header = self.request.headers.get("If-Match")
+        if header is None:
+            return False
+        etags = parse_etags(header)
+        if etags == ["*"]:
+            return False
+        if not weak_etag_match(ticket_etag(ticket), etags):
+            raise PreconditionFailed
+        return True
+
+    def retrieve(self, request, *args, **kwargs):
+        ticket = self.get_object()
+        serializer = self.get_serializer(ticket)
+        return Response(serializer.data, headers={"ETag": ticket_etag(ticket)})
+
+    def update(self, request, *args, **kwargs):
+        ticket = self.get_object()
+        serializer = self.get_serializer(
+            ticket, data=request.data, partial=kwargs.pop("partial", False)
+        )
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+        return Response(serializer.data, headers={"ETag": ticket_etag(ticket)})
+
+    def perform_update(self, serializer):
+        # Only the submitted columns are written, never a purchase_count read
+        # before concurrent purchases.
+        ticket = serializer.instance
+        conditional = self.check_if_match(ticket)
+        values = serializer.validated_data
+        try:
+            updated = Ticket.objects.update_versioned(
+                ticket.pk, values, version=ticket.version
             )
-            serializer.save(restaurant=restaurant)
-        except ObjectDoesNotExist:
+            if updated is None and not conditional:
+                updated = Ticket.objects.update_versioned(ticket.pk, values)
+        except (IntegrityError, OverflowError):
+            raise ParseError
+
+        if updated is None:
+            current = (
+                Ticket.objects.filter(pk=ticket.pk)
+                .values_list("version", flat=True)
+                .first()
+            )
+            if current is None:
+                raise NotFound
+            if conditional and current != ticket.version:
+                raise PreconditionFailed
+            raise ParseError
+
+        for field, value in values.items():
+            setattr(ticket, field, value)
+        ticket.version, ticket.purchase_count = updated
+        tickets_bulk_saved.send(sender=Ticket, tickets=[ticket])
+
+    def perform_destroy(self, instance):
+        if not self.check_if_match(instance):
+            instance.delete()
+            return
+        deleted, _ = Ticket.objects.filter(
+            pk=instance.pk, version=instance.version
+        ).delete()
+        if not deleted:
+            raise PreconditionFailed
+
+    def create(self, request, *args, **kwargs):
+        if isinstance(request.data, list):
+            return self.bulk_create(request.data)
+        return super().create(request, *args, **kwargs)
+
+    def bulk_create(self, items):
+        if not self.owned_restaurant().exists():
             raise PermissionDenied
+
+        serializer = TicketCreateSerializer(
+            data=items,
+            many=True,
+            allow_empty=False,
+            max_length=self.bulk_create_max_items,
+        )
+        if not serializer.is_valid():
+            return Response(bulk_errors(serializer), status.HTTP_400_BAD_REQUEST)
+
+        tickets = [
+            Ticket(restaurant_id=self.kwargs["restaurant_pk"], **attrs)
+            for attrs in serializer.validated_data
+        ]
+        try:
+            with transaction.atomic(savepoint=False):
+                Ticket.objects.bulk_create(
+                    tickets, batch_size=self.bulk_create_batch_size
+                )
+                Ticket.objects.record_purchases(
+                    (ticket.pk, ticket.purchase_count) for ticket in tickets
+                )
         except (IntegrityError, OverflowError):
             raise ParseError
+        tickets_bulk_saved.send(sender=Ticket, tickets=tickets)
+
+        return Response(
+            [self.ticket_fields(ticket) for ticket in tickets],
+            status.HTTP_201_CREATED,
+        )
+
+    def bulk_partial_update(self, request, *args, **kwargs):
+        serializer = TicketBulkUpdateSerializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=self.bulk_update_max_items,
+        )
+        if not serializer.is_valid():
+            return Response(bulk_errors(serializer), status.HTTP_400_BAD_REQUEST)
+
+        changes = serializer.validated_data
+        seen, duplicates = set(), {}
+        for index, change in enumerate(changes):
+            if change["id"] in seen:
+                duplicates[index] = {"id": ["Duplicate ticket id."]}
+            seen.add(change["id"])
+        if duplicates:
+            return Response(duplicates, status.HTTP_400_BAD_REQUEST)
 
-    def perform_update(self, serializer):
         try:
-            serializer.save()
+            updated, rejected = self.get_queryset().update_many(
+                changes, batch_size=self.bulk_update_batch_size
+            )
         except (IntegrityError, OverflowError):
             raise ParseError
+        if not updated and not rejected and not self.owned_restaurant().exists():
+            raise NotFound
+        if updated:
+            tickets_bulk_saved.send(sender=Ticket, tickets=list(updated.values()))
+
+        results = []
+        for change in changes:
+            pk = change["id"]
+            if pk in updated:
+                results.append({"status": "updated", **self.ticket_fields(updated[pk])})
+            elif pk in rejected:
+                results.append(
+                    {
+                        "status": "rejected",
+                        "id": pk,
+                        "errors": {
+                            "max_purchase_count": [
+                                "Cannot be less than purchase_count "
+                                f"({rejected[pk].purchase_count})."
+                            ]
+                        },
+                    }
+                )
+            else:
+                results.append({"status": "not_found", "id": pk})
+        return Response(results)
+
+    def ticket_fields(self, ticket):
+        return {
+            name: getattr(ticket, source) for name, source in self.list_fields.items()
+        }
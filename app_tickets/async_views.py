@@ -0,0 +1,139 @@
+"""
+Async variants of the public ticket read endpoints, served by the ASGI
+application.
+
+They serve the payloads of PublicTicketList and PublicTicketRetrieve, through
+the same ticket_cache and TicketPagination, and produce the same JSON.
+
+Django's async ORM and cache methods run the sync code on the one
+thread-sensitive executor thread of the process, which would serialize every
+read. Instead, the cache lookup and, on a miss, the queries run in one call on
+the event loop's default executor (thread_sensitive=False). Each of its
+threads keeps its own database connection, closed like a request's when it is
+broken or older than CONN_MAX_AGE, so reads run concurrently, up to the
+executor's size. close_thread_connections() closes them all once the executor
+is shut down, e.g. at the end of a test. Methods other than GET and HEAD, such
+as OPTIONS, go to the sync views.
+
+The export is built by the sync view, with its lines read on a thread of
+their own, see iterate_in_thread.
+"""
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, connections
+from django.http import Http404, JsonResponse
+from rest_framework.exceptions import APIException, NotFound
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+
+from . import views
+from .views import PublicTicketList, PublicTicketRetrieve
+
+
+def json_response(data, status=200):
+    return JsonResponse(
+        data,
+        status=status,
+        encoder=JSONEncoder,
+        json_dumps_params={"ensure_ascii": False, "separators": (",", ":")},
+    )
+
+
+thread_connections = weakref.WeakSet()
+
+
+def in_thread(func):
+    """`func` as a coroutine function run on the default executor."""
+
+    def call(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+            thread_connections.update(connections.all(initialized_only=True))
+
+    return sync_to_async(call, thread_sensitive=False)
+
+
+def close_thread_connections():
+    """Close the connections opened by in_thread, which must be idle."""
+    for connection in list(thread_connections):
+        connection.inc_thread_sharing()
+        try:
+            connection.close()
+        finally:
+            connection.dec_thread_sharing()
+    thread_connections.clear()
+
+
+def async_get(view_class):
+    sync_view = view_class.as_view()
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return await sync_to_async(sync_view)(request, **kwargs)
+            request = Request(request)
+            api_view = view_class(
+                request=request, format_kwarg=None, args=(), kwargs=kwargs
+            )
+            try:
+                return await view(api_view, request, **kwargs)
+            except Http404 as exc:
+                error = NotFound(str(exc))
+            except APIException as exc:
+                error = exc
+            return json_response({"detail": error.detail}, status=error.status_code)
+
+        wrapper.csrf_exempt = True
+        return wrapper
+
+    return decorator
+
+
+@async_get(PublicTicketList)
+async def ticket_list(view, request):
+    response = await in_thread(view.list)(request)
+    return json_response(response.data)
+
+
+@async_get(PublicTicketRetrieve)
+async def ticket_detail(view, request, pk):
+    response = await in_thread(view.retrieve)(request, pk=pk)
+    return json_response(response.data)
+
+
+async def iterate_in_thread(iterator):
+    """
+    Iterate a sync generator of database rows on a thread of its own, which
+    keeps the one connection a server-side cursor needs. The generator and the
+    connection are closed there at the end.
+    """
+
+    def close():
+        iterator.close()
+        connections.close_all()
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            while True:
+                item = await loop.run_in_executor(executor, next, iterator, None)
+                if item is None:
+                    return
+                yield item
+        finally:
+            await loop.run_in_executor(executor, close)
+
+
+async def ticket_export(request):
+    return await in_thread(views.ticket_export)(request, stream=iterate_in_thread)
+
+
+ticket_export.csrf_exempt = True
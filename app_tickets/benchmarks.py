@@ -0,0 +1,441 @@
+"""
+Throughput benchmarks for the public ticket endpoints.
+
+Not collected by the default test run; execute explicitly with
+
+    python manage.py test app_tickets.benchmarks
+"""
+import asyncio
+import os
+import random
+import tempfile
+import threading
+from base64 import b64encode
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from unittest import mock
+from urllib.parse import urlencode
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    OperationalError,
+    connection,
+    connections,
+    transaction,
+)
+from django.db.backends.utils import CursorWrapper
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from app_restaurants.benchmarks import percentile
+from app_restaurants.mixins import rows_to_dicts
+from app_restaurants.models import Restaurant, Ticket
+
+from . import async_views, views
+from .coalescing import PurchaseCoalescer
+from .retry import RetryBudgetExhausted
+from .serializers import PublicTicketSerializer
+from .views import process_purchase, purchase_retry
+
+BUYERS = 8
+PURCHASES_PER_BUYER = 50
+
+
+def legacy_process_purchase(pk, buy_amount):
+    try:
+        with transaction.atomic():
+            ticket = Ticket.objects.get(pk=pk)
+            ticket.purchase_count += buy_amount
+            ticket.save()
+    except IntegrityError:
+        pass
+    except OperationalError:
+        sleep(0.1)
+        legacy_process_purchase(pk, buy_amount)
+
+
+def run_concurrently(target, buyers, *args):
+    barrier = threading.Barrier(buyers + 1)
+
+    def worker():
+        barrier.wait()
+        try:
+            target(*args)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(buyers)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = perf_counter()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start
+
+
+class PurchaseThroughputBenchmark(TransactionTestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("bench", password="bench")
+        self.restaurant = Restaurant.objects.create(owner=user)
+
+    def measure(self, purchase, buyers=BUYERS):
+        ticket = Ticket.objects.create(
+            restaurant=self.restaurant,
+            max_purchase_count=buyers * PURCHASES_PER_BUYER,
+        )
+        latencies = []
+
+        def buy_many(pk):
+            for _ in range(PURCHASES_PER_BUYER):
+                start = perf_counter()
+                try:
+                    purchase(pk, 1)
+                except Exception:
+                    pass
+                latencies.append(perf_counter() - start)
+
+        elapsed = run_concurrently(buy_many, buyers, ticket.pk)
+        ticket.refresh_from_db()
+        self.assertLessEqual(ticket.purchase_count, ticket.max_purchase_count)
+        return {
+            "throughput": ticket.purchase_count / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    def test_purchases_per_second(self):
+        legacy = self.measure(legacy_process_purchase)["throughput"]
+        with mock.patch.object(views, "purchase_coalescer", None):
+            conditional_update = self.measure(process_purchase)["throughput"]
+
+        print(
+            f"\npurchases/sec with {BUYERS} concurrent buyers: "
+            f"select+save={legacy:.0f} conditional update={conditional_update:.0f} "
+            f"retries={purchase_retry.counters()}"
+        )
+
+    def test_coalesced_purchases(self):
+        buyers = 32
+        coalescer = PurchaseCoalescer(
+            views.settle_purchases,
+            max_batch_size=buyers,
+            shared_errors=(RetryBudgetExhausted,),
+        )
+
+        with mock.patch.object(views, "purchase_coalescer", None):
+            per_request = self.measure(process_purchase, buyers)
+        with mock.patch.object(views, "purchase_coalescer", coalescer):
+            coalesced = self.measure(process_purchase, buyers)
+
+        print(f"\n{buyers} concurrent buyers of one ticket:")
+        for label, result in (("per-request", per_request), ("coalesced", coalesced)):
+            print(
+                f"  {label:<12} {result['throughput']:>7.0f} purchases/sec  "
+                f"p50={result['p50_ms']:.2f}ms  p99={result['p99_ms']:.2f}ms"
+            )
+
+
+PROFILE_BUYERS = 16
+
+
+class DatabaseProfileBenchmark(TransactionTestCase):
+    """
+    Purchase throughput on file-backed SQLite with and without
+    settings.SQLITE_PRAGMAS, and on the default database when it is
+    PostgreSQL (DATABASE_PROFILE=postgresql).
+    """
+
+    @contextmanager
+    def sqlite_database(self, alias, path):
+        connections.settings[alias] = connections.configure_settings(
+            {
+                DEFAULT_DB_ALIAS: {},
+                alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": path},
+            }
+        )[alias]
+        try:
+            with mock.patch.object(type(self), "databases", {*self.databases, alias}):
+                call_command("migrate", database=alias, verbosity=0)
+                yield
+        finally:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+
+    def measure(self, alias):
+        user = User.objects.db_manager(alias).create_user("bench", password="bench")
+        restaurant = Restaurant.objects.using(alias).create(owner=user)
+        ticket = Ticket.objects.using(alias).create(
+            restaurant=restaurant,
+            max_purchase_count=PROFILE_BUYERS * PURCHASES_PER_BUYER,
+        )
+        failures = []
+
+        def buy_many():
+            try:
+                for _ in range(PURCHASES_PER_BUYER):
+                    try:
+                        purchase_retry.call(
+                            Ticket.objects.using(alias).purchase, ticket.pk, 1
+                        )
+                    except RetryBudgetExhausted:
+                        failures.append(1)
+            finally:
+                connections[alias].close()
+
+        threads = [threading.Thread(target=buy_many) for _ in range(PROFILE_BUYERS)]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        ticket.refresh_from_db()
+        self.assertLessEqual(ticket.purchase_count, ticket.max_purchase_count)
+        return ticket.purchase_count / elapsed, len(failures)
+
+    def test_purchases_per_second(self):
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for label, pragmas in (
+                ("sqlite rollback journal", {}),
+                ("sqlite tuned", settings.SQLITE_PRAGMAS),
+            ):
+                alias = label.replace(" ", "_")
+                with override_settings(SQLITE_PRAGMAS=pragmas):
+                    with self.sqlite_database(alias, os.path.join(directory, alias)):
+                        results[label] = self.measure(alias)
+        if connection.vendor == "postgresql":
+            results["postgresql"] = self.measure(DEFAULT_DB_ALIAS)
+
+        print(f"\npurchases/sec with {PROFILE_BUYERS} concurrent buyers:")
+        for label, (throughput, failures) in results.items():
+            print(f"  {label:<24} {throughput:>7.0f}  gave up={failures}")
+
+
+CATALOG_SIZE = 1_000_000
+DEEP_PAGE = 10_000
+
+
+def cursor_after(position):
+    return b64encode(urlencode({"p": position}).encode("ascii")).decode("ascii")
+
+
+class CatalogPaginationBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.bulk_create(
+            (Ticket(restaurant=restaurant) for _ in range(CATALOG_SIZE)),
+            batch_size=10_000,
+        )
+
+    def page_latency(self, params, repeat=20):
+        client = APIClient()
+        start = perf_counter()
+        for _ in range(repeat):
+            views.ticket_cache.cache.clear()
+            response = client.get("/tickets/", params)
+        self.assertEqual(len(response.data["results"]), 10)
+        return (perf_counter() - start) / repeat * 1000
+
+    def test_page_latency(self):
+        offset = (DEEP_PAGE - 1) * 10
+        results = {
+            "page 1": self.page_latency({}),
+            f"page {DEEP_PAGE}": self.page_latency({"page": DEEP_PAGE}),
+            "cursor page 1": self.page_latency({"pagination": "cursor"}),
+            f"cursor page {DEEP_PAGE}": self.page_latency(
+                {"cursor": cursor_after(offset)}
+            ),
+        }
+
+        print(f"\n/tickets/ latency over {CATALOG_SIZE} tickets:")
+        for label, latency in results.items():
+            print(f"  {label:<20} {latency:.2f}ms")
+
+
+FILTERED_CATALOG_SIZE = 200_000
+FILTERED_RESTAURANTS = 100
+SOLD_OUT_SHARE = 0.95
+
+
+class CatalogFilterBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        restaurants = Restaurant.objects.bulk_create(
+            Restaurant(owner=user) for _ in range(FILTERED_RESTAURANTS)
+        )
+        rng = random.Random(0)
+        Ticket.objects.bulk_create(
+            (
+                Ticket(
+                    restaurant=rng.choice(restaurants),
+                    max_purchase_count=10,
+                    purchase_count=10
+                    if rng.random() < SOLD_OUT_SHARE
+                    else rng.randrange(10),
+                )
+                for _ in range(FILTERED_CATALOG_SIZE)
+            ),
+            batch_size=10_000,
+        )
+        cls.restaurant = restaurants[0]
+
+    def page_latency(self, params, repeat=20):
+        client = APIClient()
+        params = dict(params, pagination="cursor")
+        start = perf_counter()
+        for _ in range(repeat):
+            views.ticket_cache.cache.clear()
+            response = client.get("/tickets/", params)
+        self.assertEqual(len(response.data["results"]), 10)
+        return (perf_counter() - start) / repeat * 1000
+
+    def client_side_latency(self, wanted=10):
+        client = APIClient()
+        views.ticket_cache.cache.clear()
+        start = perf_counter()
+        found, pages = 0, 0
+        url, params = "/tickets/", {"pagination": "cursor"}
+        while found < wanted:
+            response = client.get(url, params)
+            found += sum(row["purchase_left"] > 0 for row in response.data["results"])
+            pages += 1
+            url, params = response.data["next"], None
+        return (perf_counter() - start) * 1000, pages
+
+    def test_filtered_page_latency(self):
+        latency, pages = self.client_side_latency()
+        results = {
+            f"client-side ({pages} pages)": latency,
+            "available=true": self.page_latency({"available": "true"}),
+            "restaurant": self.page_latency({"restaurant": self.restaurant.pk}),
+            "min_left=5": self.page_latency({"min_left": 5}),
+            "ordering=-purchase_left": self.page_latency(
+                {"ordering": "-purchase_left"}
+            ),
+            "available, restaurant": self.page_latency(
+                {"available": "true", "restaurant": self.restaurant.pk}
+            ),
+        }
+
+        print(
+            f"\nFirst 10 available of {FILTERED_CATALOG_SIZE} tickets "
+            f"({SOLD_OUT_SHARE:.0%} sold out):"
+        )
+        for label, latency in results.items():
+            print(f"  {label:<28} {latency:.2f}ms")
+
+
+SERIALIZED_ROWS = 20_000
+
+
+class ListSerializationBenchmark(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user("bench", password="bench")
+        restaurants = Restaurant.objects.bulk_create(
+            Restaurant(owner=user, name=f"restaurant {n}") for n in range(100)
+        )
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=restaurants[n % 100], name=f"ticket {n}")
+            for n in range(SERIALIZED_ROWS)
+        )
+
+    def rows_per_second(self, serialize):
+        start = perf_counter()
+        rows = serialize(Ticket.objects.public())
+        elapsed = perf_counter() - start
+        self.assertEqual(len(rows), SERIALIZED_ROWS)
+        return len(rows) / elapsed
+
+    def test_rows_per_second(self):
+        fields = views.PublicTicketList.list_fields
+        serializer = self.rows_per_second(
+            lambda queryset: PublicTicketSerializer(queryset, many=True).data
+        )
+        values = self.rows_per_second(
+            lambda queryset: rows_to_dicts(queryset.values(*fields.values()), fields)
+        )
+
+        print(
+            f"\nrows/sec serializing {SERIALIZED_ROWS} public tickets: "
+            f"ModelSerializer={serializer:.0f} values()={values:.0f}"
+        )
+
+
+ASYNC_READERS = 64
+READS_PER_READER = 20
+# Round trips added to each query, as to a database across the network
+QUERY_LATENCIES = (0, 0.002)
+
+
+class AsyncReadBenchmark(TransactionTestCase):
+    """
+    Concurrent GET /tickets/<id>/ through the ASGI handler, served by the sync
+    DRF view (which Django runs on the thread-sensitive executor) and by the
+    async view. The ticket cache is bypassed, so every read queries the
+    database, without and with a simulated network round trip per query.
+    """
+
+    def setUp(self) -> None:
+        self.addCleanup(async_views.close_thread_connections)
+        user = User.objects.create_user("bench", password="bench")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.bulk_create(Ticket(restaurant=restaurant) for _ in range(100))
+        self.ids = list(Ticket.objects.values_list("id", flat=True))
+
+    def measure(self, urlconf, query_latency):
+        latencies = []
+        execute = CursorWrapper._execute
+
+        def slow_execute(cursor, *args):
+            sleep(query_latency)
+            return execute(cursor, *args)
+
+        async def reader():
+            client = AsyncClient()
+            for _ in range(READS_PER_READER):
+                start = perf_counter()
+                response = await client.get(f"/tickets/{random.choice(self.ids)}/")
+                latencies.append(perf_counter() - start)
+                self.assertEqual(response.status_code, 200)
+
+        async def read_all():
+            start = perf_counter()
+            await asyncio.gather(*(reader() for _ in range(ASYNC_READERS)))
+            return perf_counter() - start
+
+        with override_settings(ROOT_URLCONF=urlconf), mock.patch.object(
+            views.ticket_cache, "_fetch", lambda scopes, key, build: build()
+        ), mock.patch.object(CursorWrapper, "_execute", slow_execute):
+            elapsed = async_to_sync(read_all)()
+        return {
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+
+    def test_reads_per_second(self):
+        print(f"\n{ASYNC_READERS} concurrent readers of /tickets/<id>/ over ASGI:")
+        for query_latency in QUERY_LATENCIES:
+            for label, urlconf in (
+                ("sync view", "restaurants_test.urls"),
+                ("async view", "restaurants_test.asgi_urls"),
+            ):
+                result = self.measure(urlconf, query_latency)
+                print(
+                    f"  +{query_latency * 1000:.0f}ms/query {label:<12} "
+                    f"{result['throughput']:>7.0f} reads/sec  "
+                    f"p50={result['p50_ms']:.2f}ms  p99={result['p99_ms']:.2f}ms"
+                )
@@ -0,0 +1,119 @@
+import threading
+from collections import defaultdict
+from time import time_ns
+
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+
+_evictions = defaultdict(int)
+
+
+class StatsLocMemCache(LocMemCache):
+    """Least recently used local-memory cache that counts its evictions."""
+
+    def __init__(self, name, params):
+        super().__init__(name, params)
+        self.name = name
+
+    def _cull(self):
+        size = len(self._cache)
+        super()._cull()
+        _evictions[self.name] += size - len(self._cache)
+
+    @property
+    def evictions(self):
+        with self._lock:
+            return _evictions[self.name]
+
+
+class StatsRedisCache(RedisCache):
+    """
+    Redis cache that reports the evicted_keys of its server as evictions.
+    They cover every database and key prefix the server holds.
+    """
+
+    @property
+    def evictions(self):
+        return self._cache.get_client().info("stats")["evicted_keys"]
+
+
+class TicketCache:
+    """
+    Read-through cache of public ticket payloads.
+
+    Entries are keyed by version counters: "list" for every catalog page,
+    "ticket:<pk>" and "restaurants" for ticket details. Invalidating bumps the
+    counters, both right away and once the surrounding transaction commits, so
+    a reader that raced the write cannot store stale data under the new
+    version.
+    """
+
+    def __init__(self, alias="tickets"):
+        self.alias = alias
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def fetch_list(self, url, build):
+        return self._fetch(["list"], url, build)
+
+    def fetch_ticket(self, pk, build):
+        return self._fetch([f"ticket:{pk}", "restaurants"], f"detail:{pk}", build)
+
+    def invalidate_ticket(self, pk):
+        self._invalidate(["list", f"ticket:{pk}"])
+
+    def invalidate_tickets(self, pks):
+        self._invalidate(["list"] + [f"ticket:{pk}" for pk in pks])
+
+    def invalidate_restaurants(self):
+        self._invalidate(["list", "restaurants"])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["evictions"] = getattr(self.cache, "evictions", None)
+        return stats
+
+    def _fetch(self, scopes, key, build):
+        versions = self._versions(scopes)
+        key = ":".join(["tickets", key] + [str(versions[scope]) for scope in scopes])
+
+        data = self.cache.get(key)
+        if data is not None:
+            self._count("hits")
+            return data
+
+        self._count("misses")
+        data = build()
+        self.cache.set(key, data)
+        return data
+
+    def _versions(self, scopes):
+        keys = {f"tickets:version:{scope}": scope for scope in scopes}
+        versions = self.cache.get_many(keys)
+        for key in keys.keys() - versions.keys():
+            self.cache.add(key, time_ns())
+            versions[key] = self.cache.get(key)
+        return {keys[key]: version for key, version in versions.items()}
+
+    def _invalidate(self, scopes):
+        def bump():
+            for scope in scopes:
+                try:
+                    self.cache.incr(f"tickets:version:{scope}")
+                except ValueError:
+                    pass
+
+        if transaction.get_connection().in_atomic_block:
+            bump()
+        transaction.on_commit(bump)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.checks import Tags, register
+
+from app_restaurants.checks import per_process_cache_errors
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    idempotency = getattr(settings, "TICKET_PURCHASE_IDEMPOTENCY", {})
+    return per_process_cache_errors(
+        {getattr(settings, "TICKET_CACHE_ALIAS", "tickets"): "ticket"},
+        "app_tickets.E001",
+    ) + per_process_cache_errors(
+        {idempotency.get("CACHE_ALIAS", "idempotency"): "idempotency"},
+        "app_tickets.E002",
+    )
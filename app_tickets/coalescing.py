@@ -0,0 +1,102 @@
+import threading
+from concurrent.futures import Future
+
+
+class _Batch:
+    def __init__(self):
+        self.amounts = []
+        self.futures = []
+        self.closed = threading.Event()
+
+    def add(self, amount):
+        future = Future()
+        self.amounts.append(amount)
+        self.futures.append(future)
+        return future
+
+
+class PurchaseCoalescer:
+    """
+    Group commit for ticket purchases.
+
+    Purchases of a ticket are settled in batches, each with a single
+    `settle(pk, amounts)` call. A purchase with no batch of its ticket being
+    settled is settled at once, so it never waits for others. The purchases
+    arriving while a batch is being settled make up the next batch, settled
+    when that call returns, after at most `window` seconds, or once
+    `max_batch_size` purchases joined. Every purchase gets its own entry of
+    the settled result.
+
+    When the call raises, each purchase is settled on its own so that the
+    error only fails the purchases that cause it, unless it is one of
+    `shared_errors`, such as an exhausted retry budget, which fail the batch.
+    """
+
+    def __init__(self, settle, window=0.002, max_batch_size=64, shared_errors=()):
+        self.settle = settle
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.shared_errors = shared_errors
+        self._lock = threading.Lock()
+        self._batches = {}
+        # Number of batches of each ticket being settled
+        self._settling = {}
+
+    @classmethod
+    def from_settings(cls, settle, options, **kwargs):
+        options = {name.lower(): value for name, value in options.items()}
+        if not options.pop("enabled", False):
+            return None
+        return cls(settle, **options, **kwargs)
+
+    def submit(self, pk, amount):
+        with self._lock:
+            batch = self._batches.get(pk)
+            is_leader = batch is None
+            if is_leader:
+                batch = self._batches[pk] = _Batch()
+            future = batch.add(amount)
+            if len(batch.amounts) >= self.max_batch_size or pk not in self._settling:
+                self._close(pk, batch)
+
+        if is_leader:
+            batch.closed.wait(self.window)
+            with self._lock:
+                self._close(pk, batch)
+            try:
+                self._settle(pk, batch)
+            finally:
+                with self._lock:
+                    self._settling[pk] -= 1
+                    if not self._settling[pk]:
+                        del self._settling[pk]
+                        pending = self._batches.get(pk)
+                        if pending is not None:
+                            self._close(pk, pending)
+
+        return future.result()
+
+    def _close(self, pk, batch):
+        if self._batches.get(pk) is batch:
+            del self._batches[pk]
+            self._settling[pk] = self._settling.get(pk, 0) + 1
+        batch.closed.set()
+
+    def _settle(self, pk, batch):
+        self._settle_amounts(pk, batch.amounts, batch.futures)
+
+    def _settle_amounts(self, pk, amounts, futures):
+        try:
+            results = self.settle(pk, amounts)
+        except self.shared_errors as error:
+            for future in futures:
+                future.set_exception(error)
+        except Exception as error:
+            if len(amounts) == 1:
+                futures[0].set_exception(error)
+                return
+            for amount, future in zip(amounts, futures):
+                self._settle_amounts(pk, [amount], [future])
+        else:
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,62 @@
+from django.db.models import F, Q
+from rest_framework.exceptions import ParseError
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+from app_restaurants.models import field_maximum
+
+
+def parse_non_negative_int(value, name, maximum=None):
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise ParseError(f'"{name}" must be a non-negative integer')
+    if maximum is not None and number > maximum:
+        raise ParseError(f'"{name}" must be at most {maximum}')
+    return number
+
+
+class TicketAvailabilityFilter(BaseFilterBackend):
+    """
+    Filter tickets with `?available=true|false`, `?restaurant=<id>` and
+    `?min_left=<n>`, on a queryset annotated with purchase_left.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+
+        available = params.get("available")
+        if available is not None:
+            if available not in ("true", "false"):
+                raise ParseError('"available" must be true or false')
+            in_stock = Q(purchase_count__lt=F("max_purchase_count"))
+            queryset = queryset.filter(in_stock if available == "true" else ~in_stock)
+
+        restaurant = params.get("restaurant")
+        if restaurant is not None:
+            queryset = queryset.filter(
+                restaurant=parse_non_negative_int(
+                    restaurant, "restaurant", field_maximum(queryset, "restaurant")
+                )
+            )
+
+        min_left = params.get("min_left")
+        if min_left is not None:
+            queryset = queryset.filter(
+                purchase_left__gte=parse_non_negative_int(
+                    min_left, "min_left", field_maximum(queryset, "max_purchase_count")
+                )
+            )
+
+        return queryset
+
+
+class TicketOrderingFilter(OrderingFilter):
+    """OrderingFilter that breaks ties on `id`, so pages are stable."""
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if ordering and "id" not in (field.lstrip("-") for field in ordering):
+            ordering = [*ordering, "id"]
+        return ordering
@@ -0,0 +1,108 @@
+import hashlib
+from time import monotonic, sleep
+
+from django.core.cache import caches
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+
+class IdempotencyKeyInUse(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A request with this Idempotency-Key is still in progress."
+    default_code = "idempotency_key_in_use"
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "This Idempotency-Key was used for a different request."
+    default_code = "idempotency_key_reused"
+
+
+class IdempotencyStore:
+    """
+    Remembers the outcome of requests by their Idempotency-Key, in a cache
+    shared by all processes.
+
+    Outcomes are kept for `ttl` seconds; how many is up to the cache. A
+    request arriving while the first one with the same key is still running
+    polls for its outcome for up to `wait_timeout` seconds. The claim of a
+    running request lapses after `lock_timeout` seconds, in case its process
+    died. Server errors are not remembered, so such requests can be retried.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self, alias="idempotency", ttl=86400, wait_timeout=5, lock_timeout=60):
+        self.alias = alias
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.lock_timeout = lock_timeout
+
+    @classmethod
+    def from_settings(cls, options):
+        options = dict(options)
+        alias = options.pop("CACHE_ALIAS", "idempotency")
+        return cls(alias, **{name.lower(): value for name, value in options.items()})
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def run(self, key, fingerprint, func):
+        # Keys come from clients, so they are hashed to a bounded length.
+        cache_key = f"idempotency:{hashlib.sha256(key.encode()).hexdigest()}"
+        pending = {"fingerprint": fingerprint, "outcome": None}
+        if not self.cache.add(cache_key, pending, timeout=self.lock_timeout):
+            return self._replay(cache_key, fingerprint)
+
+        try:
+            response = func()
+        except APIException as error:
+            if error.status_code >= 500:
+                self.cache.delete(cache_key)
+            else:
+                self._remember(
+                    cache_key, fingerprint, ("error", error.status_code, error.detail)
+                )
+            raise
+        except BaseException:
+            self.cache.delete(cache_key)
+            raise
+
+        if response.status_code >= 500:
+            self.cache.delete(cache_key)
+        else:
+            self._remember(
+                cache_key,
+                fingerprint,
+                ("response", response.status_code, response.data),
+            )
+        return response
+
+    def _remember(self, cache_key, fingerprint, outcome):
+        self.cache.set(
+            cache_key, {"fingerprint": fingerprint, "outcome": outcome}, self.ttl
+        )
+
+    def _replay(self, cache_key, fingerprint):
+        deadline = monotonic() + self.wait_timeout
+        while True:
+            entry = self.cache.get(cache_key)
+            # Gone: the first request failed with a server error.
+            if entry is None:
+                raise IdempotencyKeyInUse
+            if entry["fingerprint"] != fingerprint:
+                raise IdempotencyKeyReused
+            if entry["outcome"] is not None:
+                break
+            if monotonic() >= deadline:
+                raise IdempotencyKeyInUse
+            sleep(self.poll_interval)
+
+        kind, status_code, data = entry["outcome"]
+        if kind == "error":
+            error = APIException(data)
+            error.status_code = status_code
+            raise error
+        return Response(data, status_code, headers={"Idempotent-Replayed": "true"})
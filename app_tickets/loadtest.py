@@ -0,0 +1,158 @@
+"""
+Concurrent purchase load test against a live server.
+
+Not collected by the default test run; execute explicitly with
+
+    python manage.py test app_tickets.loadtest
+
+Buyers hit PATCH /tickets/<pk>/buy/ over HTTP, either all on one hot ticket
+or spread over many cold ones. Results are printed as JSON, and also written
+to $LOADTEST_OUTPUT when it is set, so runs can be compared. Server threads
+each open a connection to the in-memory SQLite test database, whose shared
+cache locks whole tables; run with DATABASE_PROFILE=postgresql for realistic
+contention.
+"""
+import json
+import os
+import random
+import threading
+from collections import Counter
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from django.contrib.auth.models import User
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.db import connection
+from django.db.models import Sum
+from django.test import LiveServerTestCase
+from django.test.testcases import LiveServerThread
+
+from app_restaurants.benchmarks import percentile
+from app_restaurants.models import Restaurant, Ticket
+
+from .views import purchase_retry
+
+LOAD_BUYERS = 32
+LOAD_REQUESTS_PER_BUYER = 25
+COLD_TICKETS = 200
+# Capacity offered as a share of the demand, so some buyers hit sold out.
+CAPACITY_SHARE = 0.75
+
+
+class LoadTestServer(ThreadedWSGIServer):
+    # Room for every buyer connecting at once.
+    request_queue_size = 128
+
+
+class LoadTestServerThread(LiveServerThread):
+    server_class = LoadTestServer
+
+
+class PurchaseLoadTest(LiveServerTestCase):
+    server_thread_class = LoadTestServerThread
+
+    @classmethod
+    def _make_connections_override(cls):
+        # Server threads open their own connections, even to the in-memory
+        # SQLite test database, instead of sharing the test's one, so their
+        # purchase transactions do not interleave on a single connection.
+        return {}
+
+    def setUp(self) -> None:
+        user = User.objects.create_user("load", password="load")
+        self.restaurant = Restaurant.objects.create(owner=user)
+
+    def buy(self, pk):
+        request = Request(
+            f"{self.live_server_url}/tickets/{pk}/buy/",
+            data=b'{"tickets_to_buy":1}',
+            headers={"Content-Type": "application/json"},
+            method="PATCH",
+        )
+        try:
+            with urlopen(request, timeout=30) as response:
+                return response.status
+        except HTTPError as exc:
+            return exc.code
+        except OSError:
+            return "error"
+
+    def run_load(self, tickets):
+        rng = random.Random(0)
+        plans = [
+            [rng.choice(tickets).pk for _ in range(LOAD_REQUESTS_PER_BUYER)]
+            for _ in range(LOAD_BUYERS)
+        ]
+        latencies, outcomes = [], []
+        barrier = threading.Barrier(LOAD_BUYERS + 1)
+
+        def buyer(plan):
+            barrier.wait()
+            for pk in plan:
+                start = perf_counter()
+                code = self.buy(pk)
+                latencies.append(perf_counter() - start)
+                outcomes.append((pk, code))
+
+        threads = [threading.Thread(target=buyer, args=(plan,)) for plan in plans]
+        for thread in threads:
+            thread.start()
+        retries_before = purchase_retry.counters()
+        barrier.wait()
+        start = perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+        retries_after = purchase_retry.counters()
+
+        sold = Counter(pk for pk, code in outcomes if code == 200)
+        for ticket in Ticket.objects.filter(pk__in=[ticket.pk for ticket in tickets]):
+            self.assertLessEqual(ticket.purchase_count, ticket.max_purchase_count)
+            self.assertEqual(ticket.purchase_count, sold[ticket.pk])
+            self.assertEqual(
+                ticket.purchases.aggregate(total=Sum("amount"))["total"] or 0,
+                ticket.purchase_count,
+            )
+
+        return {
+            "buyers": LOAD_BUYERS,
+            "requests": len(outcomes),
+            "tickets": len(tickets),
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(len(outcomes) / elapsed, 1),
+            "purchases_per_second": round(sum(sold.values()) / elapsed, 1),
+            "latency_ms": {
+                name: round(percentile(latencies, fraction) * 1000, 2)
+                for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+            },
+            "status_codes": {
+                str(code): count
+                for code, count in Counter(code for _, code in outcomes).items()
+            },
+            "retries": {
+                name: retries_after[name] - retries_before[name]
+                for name in retries_after
+            },
+        }
+
+    def create_tickets(self, count):
+        demand = LOAD_BUYERS * LOAD_REQUESTS_PER_BUYER
+        capacity = max(1, int(demand * CAPACITY_SHARE / count))
+        return Ticket.objects.bulk_create(
+            Ticket(restaurant=self.restaurant, max_purchase_count=capacity)
+            for _ in range(count)
+        )
+
+    def test_purchase_load(self):
+        results = {
+            "database": connection.vendor,
+            "hot": self.run_load(self.create_tickets(1)),
+            "cold": self.run_load(self.create_tickets(COLD_TICKETS)),
+        }
+
+        output = json.dumps(results, indent=2)
+        print(f"\n{output}")
+        if os.environ.get("LOADTEST_OUTPUT"):
+            with open(os.environ["LOADTEST_OUTPUT"], "w") as file:
+                file.write(output + "\n")
@@ -0,0 +1,81 @@
+import random
+import threading
+from time import monotonic, sleep
+
+from django.db import OperationalError
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class RetryBudgetExhausted(Exception):
+    pass
+
+
+class ServiceBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Service is busy, please retry later."
+    default_code = "service_busy"
+
+    def __init__(self, wait, detail=None, code=None):
+        self.wait = wait
+        super().__init__(detail, code)
+
+
+class RetryPolicy:
+    """
+    Retries a callable on transient errors with capped exponential backoff and
+    full jitter, bounded both by attempt count and by a total deadline.
+    """
+
+    def __init__(
+        self,
+        max_attempts=5,
+        base_delay=0.01,
+        max_delay=0.2,
+        deadline=1.0,
+        retry_after=1,
+        retry_on=(OperationalError,),
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_after = retry_after
+        self.retry_on = retry_on
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "retries": 0, "exhausted": 0}
+
+    @classmethod
+    def from_settings(cls, options):
+        return cls(**{name.lower(): value for name, value in options.items()})
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        self._count("calls")
+        started = monotonic()
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except self.retry_on as error:
+                last_error = error
+                if attempt == self.max_attempts:
+                    break
+                delay = self.backoff(attempt)
+                if monotonic() - started + delay > self.deadline:
+                    break
+                self._count("retries")
+                sleep(delay)
+
+        self._count("exhausted")
+        raise RetryBudgetExhausted from last_error
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
@@ -5,7 +5,7 @@ from app_restaurants.models import Ticket
 
 class PublicTicketSerializer(serializers.ModelSerializer):
     restaurant = serializers.ReadOnlyField(source="restaurant.name")
-    purchase_left = serializers.SerializerMethodField()
+    purchase_left = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Ticket
@@ -18,6 +18,3 @@ class PublicTicketSerializer(serializers.ModelSerializer):
             "restaurant",
         ]
         read_only_fields = ["name", "max_purchase_count", "purchase_count"]
-
-    def get_purchase_left(self, ticket):
-        return ticket.max_purchase_count - ticket.purchase_count
@@ -0,0 +1,25 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from app_restaurants.models import Restaurant, Ticket
+from app_restaurants.signals import tickets_bulk_saved
+
+from .views import ticket_cache
+
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_delete, sender=Ticket)
+def invalidate_ticket(sender, instance, **kwargs):
+    ticket_cache.invalidate_ticket(instance.pk)
+
+
+@receiver(tickets_bulk_saved, sender=Ticket)
+def invalidate_tickets(sender, tickets, **kwargs):
+    ticket_cache.invalidate_tickets(ticket.pk for ticket in tickets)
+
+
+@receiver(post_save, sender=Restaurant)
+@receiver(post_delete, sender=Restaurant)
+def invalidate_restaurants(sender, instance, created=False, **kwargs):
+    if not created:
+        ticket_cache.invalidate_restaurants()
@@ -1,13 +1,38 @@
+import asyncio
+import gzip
+import json
+import threading
+import warnings
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import caches
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
 from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.mixins import ListModelMixin
+from rest_framework.response import Response
 from rest_framework.test import APIClient
 
-from app_restaurants.models import Restaurant, Ticket
+from app_restaurants.mixins import ValuesListMixin
+from app_restaurants.models import Restaurant, Ticket, supports_update_returning
+from app_tickets import async_views, checks, views
+from app_tickets.cache import StatsLocMemCache
+from app_tickets.coalescing import PurchaseCoalescer
+from app_tickets.idempotency import IdempotencyKeyInUse, IdempotencyStore
+from app_tickets.retry import RetryBudgetExhausted, RetryPolicy, ServiceBusy
 
 
 class TicketsTests(TestCase):
     def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
         user = User.objects.create_user("test", password="test")
         restaurant = Restaurant.objects.create(owner=user)
         Ticket.objects.create(restaurant=restaurant, max_purchase_count=1)
@@ -121,3 +146,1198 @@ class TicketsTests(TestCase):
         response_empty_body = client.patch(endpoint, {})
 
         self.assertEqual(response_empty_body.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response_non_existent = client.patch("/tickets/2/buy/", {"tickets_to_buy": 1})
+
+        self.assertEqual(response_non_existent.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BatchPurchaseTests(TestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user, name="r")
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=2)
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=1)
+
+    def test_allowed_methods(self):
+        response = APIClient().options("/tickets/buy/")
+
+        self.assertEqual(
+            sorted(response.headers.get("Allow").split(", ")), ["OPTIONS", "PATCH"]
+        )
+
+    def test_batch_purchase(self):
+        client = APIClient()
+        endpoint = "/tickets/buy/"
+
+        response = client.patch(
+            endpoint,
+            [
+                {"ticket_id": 2, "tickets_to_buy": 1},
+                {"ticket_id": 1, "tickets_to_buy": 1},
+                {"ticket_id": 1, "tickets_to_buy": 1},
+            ],
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data,
+            [
+                {
+                    "id": 1,
+                    "name": "",
+                    "max_purchase_count": 2,
+                    "purchase_count": 2,
+                    "purchase_left": 0,
+                    "restaurant": "r",
+                },
+                {
+                    "id": 2,
+                    "name": "",
+                    "max_purchase_count": 1,
+                    "purchase_count": 1,
+                    "purchase_left": 0,
+                    "restaurant": "r",
+                },
+            ],
+        )
+
+    def test_batch_purchase_is_all_or_nothing(self):
+        client = APIClient()
+        endpoint = "/tickets/buy/"
+
+        response_sold_out = client.patch(
+            endpoint,
+            [
+                {"ticket_id": 1, "tickets_to_buy": 1},
+                {"ticket_id": 2, "tickets_to_buy": 2},
+            ],
+        )
+
+        self.assertEqual(response_sold_out.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response_non_existent = client.patch(
+            endpoint,
+            [
+                {"ticket_id": 1, "tickets_to_buy": 1},
+                {"ticket_id": 3, "tickets_to_buy": 1},
+            ],
+        )
+
+        self.assertEqual(response_non_existent.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(
+            list(
+                Ticket.objects.order_by("pk").values_list("purchase_count", flat=True)
+            ),
+            [0, 0],
+        )
+
+    def test_batch_purchase_bad_body(self):
+        client = APIClient()
+        endpoint = "/tickets/buy/"
+
+        for body in (
+            [],
+            {},
+            [1],
+            [{"ticket_id": 1}],
+            [{"ticket_id": "1", "tickets_to_buy": 1}],
+            [{"ticket_id": 1, "tickets_to_buy": 1.1}],
+        ):
+            response = client.patch(endpoint, body)
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConcurrentPurchaseTests(TransactionTestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        self.ticket = Ticket.objects.create(
+            restaurant=restaurant, max_purchase_count=20
+        )
+
+    def test_concurrent_purchases_do_not_oversell(self):
+        endpoint = f"/tickets/{self.ticket.pk}/buy/"
+        buyers = 8
+        attempts_per_buyer = 5
+        barrier = threading.Barrier(buyers)
+        status_codes = []
+
+        def buy():
+            client = APIClient()
+            barrier.wait()
+            try:
+                for _ in range(attempts_per_buyer):
+                    response = client.patch(endpoint, {"tickets_to_buy": 1})
+                    status_codes.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy) for _ in range(buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.ticket.refresh_from_db()
+
+        self.assertEqual(self.ticket.purchase_count, 20)
+        self.assertEqual(status_codes.count(status.HTTP_200_OK), 20)
+        self.assertEqual(
+            status_codes.count(status.HTTP_400_BAD_REQUEST),
+            buyers * attempts_per_buyer - 20,
+        )
+
+
+@skipUnless(connection.vendor == "postgresql", "Needs a PostgreSQL server")
+class PostgreSQLPurchaseTests(TransactionTestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=3)
+
+    def test_purchase_many_locks_only_the_ticket(self):
+        locked, release = threading.Event(), threading.Event()
+
+        def lock_restaurant():
+            with transaction.atomic():
+                Restaurant.objects.select_for_update().get(pk=1)
+                locked.set()
+                release.wait(5)
+            connection.close()
+
+        thread = threading.Thread(target=lock_restaurant)
+        thread.start()
+        locked.wait(5)
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL lock_timeout = '1s'")
+                tickets = Ticket.objects.purchase_many(1, [2, -1])
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual([ticket.purchase_count for ticket in tickets], [2, 1])
+
+
+class RetryPolicyTests(TestCase):
+    def test_retries_until_success(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, deadline=1)
+        outcomes = [OperationalError, OperationalError, "ok"]
+
+        def flaky():
+            outcome = outcomes.pop(0)
+            if outcome is OperationalError:
+                raise OperationalError
+            return outcome
+
+        self.assertEqual(policy.call(flaky), "ok")
+        self.assertEqual(policy.counters(), {"calls": 1, "retries": 2, "exhausted": 0})
+
+    def test_gives_up_after_max_attempts(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, deadline=1)
+        attempts = []
+
+        def locked():
+            attempts.append(1)
+            raise OperationalError
+
+        with self.assertRaises(RetryBudgetExhausted):
+            policy.call(locked)
+
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(policy.counters(), {"calls": 1, "retries": 2, "exhausted": 1})
+
+    def test_gives_up_at_deadline(self):
+        policy = RetryPolicy(
+            max_attempts=100, base_delay=0.05, max_delay=0.05, deadline=0.1
+        )
+
+        def locked():
+            raise OperationalError
+
+        started = monotonic()
+        with self.assertRaises(RetryBudgetExhausted):
+            policy.call(locked)
+
+        self.assertLess(monotonic() - started, 0.2)
+        self.assertEqual(policy.counters()["exhausted"], 1)
+
+    def test_does_not_retry_other_errors(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0)
+
+        def broken():
+            raise IntegrityError
+
+        with self.assertRaises(IntegrityError):
+            policy.call(broken)
+
+        self.assertEqual(policy.counters()["retries"], 0)
+
+    def test_exhausted_purchase_returns_service_unavailable(self):
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=1)
+
+        client = APIClient()
+
+        # Purchases are coalesced by default, and settled with purchase_many
+        with mock.patch.object(
+            Ticket.objects, "purchase_many", side_effect=OperationalError
+        ), mock.patch.object(views.purchase_retry, "base_delay", 0):
+            response = client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(
+            response.headers.get("Retry-After"), str(views.purchase_retry.retry_after)
+        )
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 0)
+
+    @override_settings(REQUEST_METRICS={"INTERNAL_NETWORKS": ["127.0.0.0/8"]})
+    def test_counters_in_metrics(self):
+        counters = {"calls": 3, "retries": 2, "exhausted": 1}
+
+        with mock.patch.object(views.purchase_retry, "counters", return_value=counters):
+            body = APIClient().get("/metrics/").content.decode()
+
+        self.assertIn("# TYPE ticket_purchase_retries_total counter", body)
+        self.assertIn("ticket_purchase_calls_total 3\n", body)
+        self.assertIn("ticket_purchase_retries_total 2\n", body)
+        self.assertIn("ticket_purchase_retries_exhausted_total 1\n", body)
+
+
+class PurchaseCoalescingTests(TestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=3)
+
+    def test_purchase_many(self):
+        tickets = Ticket.objects.purchase_many(1, [1, 1])
+
+        self.assertEqual([ticket.purchase_count for ticket in tickets], [1, 2])
+
+        tickets = Ticket.objects.purchase_many(1, [2, 1, -1])
+
+        self.assertIsNone(tickets[0])
+        self.assertEqual([ticket.purchase_count for ticket in tickets[1:]], [3, 2])
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 2)
+
+        self.assertEqual(Ticket.objects.purchase_many(2, [1]), [None])
+
+    def test_purchase_many_with_overflowing_total(self):
+        for amounts in ([1, 2 ** 63], [1, 2 ** 62, 2 ** 62]):
+            Ticket.objects.filter(pk=1).update(purchase_count=0)
+
+            tickets = Ticket.objects.purchase_many(1, amounts)
+
+            self.assertEqual(tickets[0].purchase_count, 1)
+            self.assertEqual(tickets[1:], [None] * (len(amounts) - 1))
+
+    def submit_together(self, coalescer, amounts):
+        """
+        Submit purchases of ticket 1 while another one is being settled, so
+        that they make up the next batch. Returns their results or errors.
+        """
+        settle = coalescer.settle
+        in_flight, release = threading.Event(), threading.Event()
+
+        def settle_first_when_released(pk, amounts):
+            if not in_flight.is_set():
+                in_flight.set()
+                release.wait(5)
+                return [None]
+            return settle(pk, amounts)
+
+        coalescer.settle = settle_first_when_released
+        results = {}
+
+        def submit(amount):
+            try:
+                results[amount] = coalescer.submit(1, amount)
+            except Exception as error:
+                results[amount] = type(error)
+
+        first = threading.Thread(target=coalescer.submit, args=(1, None))
+        first.start()
+        in_flight.wait(5)
+        threads = [threading.Thread(target=submit, args=(n,)) for n in amounts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        release.set()
+        first.join()
+        return results
+
+    def test_concurrent_submissions_are_settled_together(self):
+        settled = []
+
+        def settle(pk, amounts):
+            settled.append((pk, list(amounts)))
+            return [pk * amount for amount in amounts]
+
+        coalescer = PurchaseCoalescer(settle, window=5, max_batch_size=4)
+        results = self.submit_together(coalescer, range(4))
+
+        self.assertEqual(len(settled), 1)
+        self.assertEqual(sorted(settled[0][1]), [0, 1, 2, 3])
+        self.assertEqual(results, {0: 0, 1: 1, 2: 2, 3: 3})
+
+    def test_batches_do_not_wait_for_idle_tickets(self):
+        release = threading.Event()
+
+        def settle(pk, amounts):
+            release.wait(5)
+            return amounts
+
+        coalescer = PurchaseCoalescer(settle, window=5)
+        started = monotonic()
+        release.set()
+
+        self.assertEqual(coalescer.submit(1, 1), 1)
+
+        release.clear()
+        first = threading.Thread(target=coalescer.submit, args=(1, 1))
+        first.start()
+        second = threading.Thread(target=coalescer.submit, args=(1, 2))
+        second.start()
+        sleep(0.1)
+        release.set()
+        first.join()
+        second.join()
+
+        # The second batch was settled as soon as the first one was.
+        self.assertLess(monotonic() - started, 1)
+
+    def test_settle_errors_reach_every_submission(self):
+        def settle(pk, amounts):
+            raise RetryBudgetExhausted
+
+        coalescer = PurchaseCoalescer(settle, window=0)
+
+        with self.assertRaises(RetryBudgetExhausted):
+            coalescer.submit(1, 1)
+
+    def test_settle_errors_fail_only_their_submission(self):
+        def settle(pk, amounts):
+            if 2 in amounts:
+                raise OverflowError
+            if 3 in amounts:
+                raise RetryBudgetExhausted
+            return amounts
+
+        for amounts, expected in (
+            ([0, 1, 2], {0: 0, 1: 1, 2: OverflowError}),
+            ([0, 1, 3], dict.fromkeys([0, 1, 3], RetryBudgetExhausted)),
+        ):
+            coalescer = PurchaseCoalescer(
+                settle,
+                window=5,
+                max_batch_size=3,
+                shared_errors=(RetryBudgetExhausted,),
+            )
+
+            self.assertEqual(self.submit_together(coalescer, amounts), expected)
+
+    def test_coalesced_ticket_purchase(self):
+        coalescer = PurchaseCoalescer(views.settle_purchases, window=0)
+        client = APIClient()
+
+        with mock.patch.object(views, "purchase_coalescer", coalescer):
+            response = client.patch("/tickets/1/buy/", {"tickets_to_buy": 3})
+            response_sold_out = client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["purchase_left"], 0)
+        self.assertEqual(response_sold_out.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_out_of_range_purchase_is_not_settled(self):
+        settle = mock.Mock(side_effect=views.settle_purchases)
+        coalescer = PurchaseCoalescer(settle, window=0)
+
+        with mock.patch.object(views, "purchase_coalescer", coalescer):
+            for amount in (2 ** 63, -(2 ** 63)):
+                response = APIClient().patch(
+                    "/tickets/1/buy/", {"tickets_to_buy": amount}, format="json"
+                )
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        settle.assert_not_called()
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=2)
+
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Token " + Token.objects.create(user=user).key
+        )
+
+        caches["idempotency"].clear()
+        patcher = mock.patch.object(views, "purchase_responses", IdempotencyStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_replayed_purchase(self):
+        client = self.client
+        endpoint = "/tickets/1/buy/"
+
+        response = client.patch(
+            endpoint, {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="a"
+        )
+        response_replayed = client.patch(
+            endpoint, {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="a"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_replayed.status_code, status.HTTP_200_OK)
+        self.assertEqual(response_replayed.data, response.data)
+        self.assertEqual(response_replayed.headers.get("Idempotent-Replayed"), "true")
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 1)
+
+        response_new_key = client.patch(
+            endpoint, {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="b"
+        )
+
+        self.assertEqual(response_new_key.data["purchase_count"], 2)
+
+        response_rejected = client.patch(
+            endpoint, {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="c"
+        )
+        Ticket.objects.filter(pk=1).update(purchase_count=0)
+        response_rejected_replayed = client.patch(
+            endpoint, {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="c"
+        )
+
+        self.assertEqual(response_rejected.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response_rejected_replayed.status_code, status.HTTP_400_BAD_REQUEST
+        )
+
+    def test_key_reused_for_other_request(self):
+        client = self.client
+
+        client.patch("/tickets/1/buy/", {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="a")
+        response = client.patch(
+            "/tickets/1/buy/", {"tickets_to_buy": 2}, HTTP_IDEMPOTENCY_KEY="a"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_keys_are_scoped_by_client(self):
+        users = [User.objects.create_user(name, password=name) for name in "ab"]
+        for user in users:
+            client = APIClient()
+            client.credentials(
+                HTTP_AUTHORIZATION="Token " + Token.objects.create(user=user).key
+            )
+            response = client.patch(
+                "/tickets/1/buy/", {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="a"
+            )
+
+            self.assertNotIn("Idempotent-Replayed", response)
+
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 2)
+
+    def test_anonymous_keys_are_rejected(self):
+        client = APIClient()
+
+        for endpoint, data in (
+            ("/tickets/1/buy/", {"tickets_to_buy": 1}),
+            ("/tickets/buy/", [{"ticket_id": 1, "tickets_to_buy": 1}]),
+        ):
+            response = client.patch(endpoint, data, HTTP_IDEMPOTENCY_KEY="a")
+
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 0)
+
+        response_without_key = client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        self.assertEqual(response_without_key.status_code, status.HTTP_200_OK)
+
+    def test_keys_are_scoped_by_endpoint(self):
+        client = self.client
+
+        client.patch("/tickets/1/buy/", {"tickets_to_buy": 1}, HTTP_IDEMPOTENCY_KEY="a")
+        response = client.patch(
+            "/tickets/buy/",
+            [{"ticket_id": 1, "tickets_to_buy": 1}],
+            HTTP_IDEMPOTENCY_KEY="a",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Ticket.objects.get(pk=1).purchase_count, 2)
+
+    def test_concurrent_duplicates_wait_for_first(self):
+        store = IdempotencyStore()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow_purchase():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return Response({"ok": True})
+
+        responses = []
+        first = threading.Thread(
+            target=lambda: responses.append(store.run("k", "f", slow_purchase))
+        )
+        first.start()
+        started.wait()
+        duplicate = threading.Thread(
+            target=lambda: responses.append(store.run("k", "f", slow_purchase))
+        )
+        duplicate.start()
+        release.set()
+        first.join()
+        duplicate.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([response.data for response in responses], [{"ok": True}] * 2)
+
+    def test_server_errors_are_not_remembered(self):
+        store = IdempotencyStore()
+
+        def busy():
+            raise ServiceBusy(wait=1)
+
+        with self.assertRaises(ServiceBusy):
+            store.run("k", "f", busy)
+
+        response = store.run("k", "f", lambda: Response({"ok": True}))
+
+        self.assertNotIn("Idempotent-Replayed", response)
+
+    def test_client_errors_are_replayed(self):
+        store = IdempotencyStore()
+
+        def rejected():
+            raise ParseError("Cannot buy")
+
+        with self.assertRaises(ParseError):
+            store.run("k", "f", rejected)
+        with self.assertRaises(APIException) as replayed:
+            store.run("k", "f", lambda: Response({}))
+
+        self.assertEqual(replayed.exception.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(replayed.exception.detail, "Cannot buy")
+
+    def test_expiry(self):
+        store = IdempotencyStore(ttl=0)
+        calls = []
+
+        def purchase():
+            calls.append(1)
+            return Response({})
+
+        store.run("a", "f", purchase)
+        store.run("a", "f", purchase)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_lapsed_claim(self):
+        store = IdempotencyStore(lock_timeout=1, wait_timeout=0)
+        started, release = threading.Event(), threading.Event()
+
+        def stuck():
+            started.set()
+            release.wait()
+            return Response({})
+
+        thread = threading.Thread(target=store.run, args=("k", "f", stuck))
+        thread.start()
+        started.wait()
+        try:
+            with self.assertRaises(IdempotencyKeyInUse):
+                store.run("k", "f", lambda: Response({}))
+            sleep(1.1)
+            response = store.run("k", "f", lambda: Response({"ok": True}))
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertEqual(response.data, {"ok": True})
+
+
+class CursorPaginationTests(TestCase):
+    def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user)
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=restaurant, name=str(n)) for n in range(15)
+        )
+
+    def test_cursor_pagination(self):
+        client = APIClient()
+
+        response = client.get("/tickets/", {"pagination": "cursor"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", response.data)
+        self.assertIsNone(response.data.get("previous"))
+        self.assertEqual(
+            [ticket["id"] for ticket in response.data.get("results")],
+            list(range(1, 11)),
+        )
+
+        response_next = client.get(response.data.get("next"))
+
+        self.assertEqual(response_next.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [ticket["id"] for ticket in response_next.data.get("results")],
+            list(range(11, 16)),
+        )
+        self.assertIsNone(response_next.data.get("next"))
+
+        response_bad_cursor = client.get("/tickets/", {"cursor": "bad"})
+
+        self.assertEqual(response_bad_cursor.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(TICKET_PAGINATION="cursor")
+    def test_cursor_pagination_by_setting(self):
+        client = APIClient()
+
+        response = client.get("/tickets/")
+
+        self.assertNotIn("count", response.data)
+        self.assertEqual(len(response.data.get("results")), 10)
+
+        response_page = client.get("/tickets/", {"pagination": "page"})
+
+        self.assertEqual(response_page.data.get("count"), 15)
+
+
+class CatalogFilterTests(TestCase):
+    def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        first, second = Restaurant.objects.bulk_create(
+            Restaurant(owner=user, name=name) for name in "ab"
+        )
+        Ticket.objects.bulk_create(
+            Ticket(
+                restaurant=first if n % 2 else second,
+                max_purchase_count=10,
+                purchase_count=min(n, 10),
+            )
+            for n in range(15)
+        )
+        self.first = first
+
+    def get_ids(self, params):
+        response = APIClient().get("/tickets/", params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [ticket["id"] for ticket in response.data["results"]]
+
+    def test_filters(self):
+        self.assertEqual(self.get_ids({"available": "true"}), list(range(1, 11)))
+        self.assertEqual(self.get_ids({"available": "false"}), list(range(11, 16)))
+        self.assertEqual(
+            self.get_ids({"restaurant": self.first.pk}), list(range(2, 16, 2))
+        )
+        self.assertEqual(self.get_ids({"min_left": 7}), [1, 2, 3, 4])
+        self.assertEqual(
+            self.get_ids(
+                {"available": "true", "restaurant": self.first.pk, "min_left": 5}
+            ),
+            [2, 4, 6],
+        )
+
+    def test_ordering(self):
+        self.assertEqual(
+            self.get_ids({"ordering": "-purchase_left"}), list(range(1, 11))
+        )
+        self.assertEqual(
+            self.get_ids({"ordering": "purchase_left"}),
+            [11, 12, 13, 14, 15, 10, 9, 8, 7, 6],
+        )
+
+        client = APIClient()
+        params = {"ordering": "purchase_left", "pagination": "cursor"}
+        response = client.get("/tickets/", params)
+        ids = [ticket["id"] for ticket in response.data["results"]]
+        response = client.get(response.data["next"])
+        ids += [ticket["id"] for ticket in response.data["results"]]
+        response = client.get(response.data["previous"])
+
+        self.assertEqual(ids, [11, 12, 13, 14, 15] + list(range(10, 0, -1)))
+        self.assertEqual(
+            [ticket["id"] for ticket in response.data["results"]], ids[:10]
+        )
+
+    def test_bad_filters(self):
+        client = APIClient()
+
+        for params in (
+            {"available": "yes"},
+            {"restaurant": "a"},
+            {"restaurant": "99999999999999999999999"},
+            {"min_left": -1},
+            {"min_left": "99999999999999999999999"},
+        ):
+            response = client.get("/tickets/", params)
+
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QueryCountTests(TestCase):
+    def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        for restaurant in Restaurant.objects.bulk_create(
+            Restaurant(owner=user, name=str(n)) for n in range(3)
+        ):
+            Ticket.objects.bulk_create(
+                Ticket(restaurant=restaurant, max_purchase_count=10) for _ in range(4)
+            )
+        # The counter update, plus the ledger INSERT, which PostgreSQL makes
+        # in the same statement
+        self.update_queries = 1 if supports_update_returning(connection) else 2
+        self.purchase_queries = self.update_queries + (
+            0 if connection.vendor == "postgresql" else 1
+        )
+
+    def test_list_and_retrieve(self):
+        client = APIClient()
+
+        with self.assertNumQueries(2):
+            response = client.get("/tickets/")
+
+        self.assertEqual(len(response.data.get("results")), 10)
+
+        with self.assertNumQueries(1):
+            response = client.get("/tickets/", {"pagination": "cursor"})
+
+        self.assertEqual(len(response.data.get("results")), 10)
+
+        with self.assertNumQueries(1):
+            client.get("/tickets/1/")
+
+        with self.assertNumQueries(0):
+            client.get("/tickets/")
+            client.get("/tickets/", {"pagination": "cursor"})
+            client.get("/tickets/1/")
+
+    def test_purchase(self):
+        client = APIClient()
+
+        with self.assertNumQueries(self.purchase_queries):
+            client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        with self.assertNumQueries(self.purchase_queries), mock.patch.object(
+            views, "purchase_coalescer", None
+        ):
+            client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        # A coalesced batch, whose ledger rows PostgreSQL also inserts in the
+        # statement of the UPDATE
+        with self.assertNumQueries(self.purchase_queries):
+            Ticket.objects.purchase_many(1, [1, 2, 3])
+
+        # One ledger INSERT for the batch
+        with self.assertNumQueries(2 + 3 * self.update_queries + 1):
+            client.patch(
+                "/tickets/buy/",
+                [{"ticket_id": pk, "tickets_to_buy": 1} for pk in (1, 5, 9)],
+            )
+
+    def test_export(self):
+        # A single query, read in chunks
+        with self.assertNumQueries(1), mock.patch.object(views, "EXPORT_CHUNK_SIZE", 5):
+            lines = b"".join(self.client.get("/tickets/export/").streaming_content)
+
+        self.assertEqual(len(lines.splitlines()), 12)
+
+        with self.assertNumQueries(1):
+            b"".join(
+                self.client.get(
+                    "/tickets/export/", {"after_id": 4}, HTTP_ACCEPT_ENCODING="gzip"
+                ).streaming_content
+            )
+
+
+class TicketCacheTests(TestCase):
+    def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        self.token = Token.objects.create(user=user)
+        restaurant = Restaurant.objects.create(owner=user, name="r")
+        Ticket.objects.create(restaurant=restaurant, max_purchase_count=5)
+
+    def test_purchase_invalidates(self):
+        client = APIClient()
+
+        client.get("/tickets/")
+        client.get("/tickets/1/")
+
+        client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+        client.patch("/tickets/buy/", [{"ticket_id": 1, "tickets_to_buy": 1}])
+
+        self.assertEqual(client.get("/tickets/1/").data["purchase_count"], 2)
+        self.assertEqual(
+            client.get("/tickets/").data["results"][0]["purchase_count"], 2
+        )
+
+        coalescer = PurchaseCoalescer(views.settle_purchases, window=0)
+        with mock.patch.object(views, "purchase_coalescer", coalescer):
+            client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+
+        self.assertEqual(client.get("/tickets/1/").data["purchase_count"], 3)
+
+    def test_owner_changes_invalidate(self):
+        client = APIClient()
+
+        client.get("/tickets/")
+        client.get("/tickets/1/")
+
+        owner = APIClient()
+        owner.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        owner.patch("/restaurants/1/tickets/1/", {"name": "a"})
+        owner.patch("/restaurants/1/", {"name": "b"})
+
+        self.assertEqual(client.get("/tickets/1/").data["name"], "a")
+        self.assertEqual(client.get("/tickets/").data["results"][0]["restaurant"], "b")
+
+        owner.delete("/restaurants/1/tickets/1/")
+
+        self.assertEqual(
+            client.get("/tickets/1/").status_code, status.HTTP_404_NOT_FOUND
+        )
+        self.assertEqual(client.get("/tickets/").data["count"], 0)
+
+    def test_stats(self):
+        client = APIClient()
+        stats = views.ticket_cache.stats()
+
+        client.get("/tickets/1/")
+        client.get("/tickets/1/")
+
+        new_stats = views.ticket_cache.stats()
+
+        self.assertEqual(new_stats["hits"] - stats["hits"], 1)
+        self.assertEqual(new_stats["misses"] - stats["misses"], 1)
+
+        cache = StatsLocMemCache(
+            "eviction-test", {"OPTIONS": {"MAX_ENTRIES": 2, "CULL_FREQUENCY": 2}}
+        )
+        for key in "abc":
+            cache.set(key, key)
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_tickets_with_equal_versions(self):
+        Ticket.objects.create(
+            restaurant=Restaurant.objects.get(), name="b", max_purchase_count=5
+        )
+        cache = views.ticket_cache.cache
+        cache.set_many({"tickets:version:ticket:1": 7, "tickets:version:ticket:2": 7})
+        client = APIClient()
+
+        self.assertEqual(client.get("/tickets/1/").data["id"], 1)
+        self.assertEqual(client.get("/tickets/2/").data["id"], 2)
+
+        client.patch("/tickets/1/buy/", {"tickets_to_buy": 1})
+        cache.set("tickets:version:ticket:2", cache.get("tickets:version:ticket:1"))
+
+        self.assertEqual(client.get("/tickets/2/").data["purchase_count"], 0)
+        self.assertEqual(client.get("/tickets/1/").data["purchase_count"], 1)
+
+    @skipUnless(
+        settings.CACHES["tickets"]["BACKEND"].endswith("StatsRedisCache"),
+        "Needs the redis cache profile",
+    )
+    def test_redis_evictions(self):
+        self.assertIsInstance(views.ticket_cache.stats()["evictions"], int)
+
+    @override_settings(REQUEST_METRICS={"INTERNAL_NETWORKS": ["127.0.0.0/8"]})
+    def test_stats_in_metrics(self):
+        APIClient().get("/tickets/1/")
+        stats = views.ticket_cache.stats()
+
+        body = APIClient().get("/metrics/").content.decode()
+
+        self.assertIn("# TYPE ticket_cache_hits_total counter", body)
+        self.assertIn(f"ticket_cache_misses_total {stats['misses']}\n", body)
+        self.assertIn(f"ticket_cache_hits_total {stats['hits']}\n", body)
+
+    def test_shared_cache_check(self):
+        with override_settings(CACHES=settings.CACHE_PROFILES["local"]):
+            self.assertEqual(
+                [error.id for error in checks.check_shared_caches(None)],
+                ["app_tickets.E001", "app_tickets.E002"],
+            )
+
+        with override_settings(CACHES=settings.CACHE_PROFILES["redis"]):
+            self.assertEqual(checks.check_shared_caches(None), [])
+
+
+class ValuesListTests(TestCase):
+    def setUp(self) -> None:
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user, name='r "1" ✓')
+        Ticket.objects.create(
+            restaurant=restaurant, name="ü", max_purchase_count=5, purchase_count=2
+        )
+        Ticket.objects.create(restaurant=restaurant, name="b")
+
+    def test_matches_serializer_output(self):
+        client = APIClient()
+
+        for params in ({}, {"pagination": "cursor"}):
+            fast = client.get("/tickets/", params).content
+
+            views.ticket_cache.cache.clear()
+            with mock.patch.object(ValuesListMixin, "list", ListModelMixin.list):
+                serialized = client.get("/tickets/", params).content
+
+            self.assertEqual(fast, serialized)
+
+
+class AsyncReadTests(TransactionTestCase):
+    # The async views read on executor threads with their own connections,
+    # which only see committed rows.
+    reset_sequences = True
+
+    def setUp(self) -> None:
+        self.addCleanup(async_views.close_thread_connections)
+        views.ticket_cache.cache.clear()
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user, name='r "1" ✓')
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=restaurant, name=f"ü{n}", max_purchase_count=n)
+            for n in range(15)
+        )
+
+    def assertSameResponses(self, path, params=None):
+        sync_response = APIClient().get(path, params)
+        with override_settings(ROOT_URLCONF="restaurants_test.asgi_urls"):
+            async_response = async_to_sync(AsyncClient().get)(path, params)
+
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        self.assertEqual(async_response.content, sync_response.content)
+        return async_response
+
+    def test_list_matches_sync_view(self):
+        for params in ({}, {"pagination": "cursor"}):
+            response = self.assertSameResponses("/tickets/", params)
+            while response.json()["next"]:
+                response = self.assertSameResponses(response.json()["next"])
+            if response.json()["previous"]:
+                self.assertSameResponses(response.json()["previous"])
+
+        for params in (
+            {"page": "last"},
+            {"page": 5},
+            {"page": "x"},
+            {"cursor": "x"},
+            {"available": "x"},
+        ):
+            self.assertSameResponses("/tickets/", params)
+
+    def test_filtered_list_matches_sync_view(self):
+        Ticket.objects.filter(pk__lte=4).update(purchase_count=F("max_purchase_count"))
+        filters = {"available": "true", "min_left": 3, "ordering": "-purchase_left"}
+
+        for params in (filters, dict(filters, pagination="cursor")):
+            response = self.assertSameResponses("/tickets/", params)
+            while response.json()["next"]:
+                response = self.assertSameResponses(response.json()["next"])
+            if response.json()["previous"]:
+                self.assertSameResponses(response.json()["previous"])
+
+    def test_detail_matches_sync_view(self):
+        self.assertSameResponses("/tickets/3/")
+        self.assertSameResponses("/tickets/100/")
+
+    def test_other_methods_match_sync_view(self):
+        for path in ("/tickets/", "/tickets/3/"):
+            for method in ("options", "post"):
+                sync_response = getattr(APIClient(), method)(path)
+                with override_settings(ROOT_URLCONF="restaurants_test.asgi_urls"):
+                    async_response = async_to_sync(getattr(AsyncClient(), method))(path)
+
+                self.assertEqual(async_response.status_code, sync_response.status_code)
+                self.assertEqual(async_response.content, sync_response.content)
+                self.assertEqual(async_response["Allow"], sync_response["Allow"])
+
+    def test_export_matches_sync_view(self):
+        async def export(params, headers):
+            response = await AsyncClient().get(
+                "/tickets/export/", params, headers=headers
+            )
+            if not response.streaming:
+                return response, response.content
+            return response, b"".join([part async for part in response])
+
+        for params, headers in (
+            ({}, {}),
+            ({"after_id": 3}, {"Accept-Encoding": "gzip"}),
+            ({"after_id": "x"}, {"Accept": "application/x-ndjson"}),
+        ):
+            sync_response = self.client.get("/tickets/export/", params, headers=headers)
+            sync_content = b"".join(sync_response) if sync_response.streaming else b""
+            with override_settings(
+                ROOT_URLCONF="restaurants_test.asgi_urls"
+            ), warnings.catch_warnings():
+                warnings.simplefilter("error")
+                async_response, async_content = async_to_sync(export)(params, headers)
+
+            self.assertEqual(async_response.status_code, sync_response.status_code)
+            self.assertEqual(async_response.headers, sync_response.headers)
+            self.assertEqual(async_content, sync_content or sync_response.content)
+
+    @override_settings(ROOT_URLCONF="restaurants_test.asgi_urls")
+    def test_reads_run_concurrently(self):
+        # Each read waits for the others, so they only finish if none of them
+        # waits for a single executor thread.
+        barrier = threading.Barrier(3, timeout=5)
+        fetch_ticket = views.ticket_cache.fetch_ticket
+
+        def wait_and_fetch(pk, build):
+            barrier.wait()
+            return fetch_ticket(pk, build)
+
+        async def read_all():
+            client = AsyncClient()
+            return await asyncio.gather(
+                *(client.get(f"/tickets/{pk}/") for pk in (1, 2, 3))
+            )
+
+        with mock.patch.object(views.ticket_cache, "fetch_ticket", wait_and_fetch):
+            responses = async_to_sync(read_all)()
+
+        self.assertEqual([response.json()["id"] for response in responses], [1, 2, 3])
+
+    @override_settings(ROOT_URLCONF="restaurants_test.asgi_urls")
+    def test_cache_is_shared_with_sync_views(self):
+        APIClient().get("/tickets/")
+        APIClient().get("/tickets/3/")
+
+        with self.assertNumQueries(0):
+            async_to_sync(AsyncClient().get)("/tickets/")
+            async_to_sync(AsyncClient().get)("/tickets/3/")
+
+        APIClient().patch("/tickets/3/buy/", {"tickets_to_buy": 1})
+        response = async_to_sync(AsyncClient().get)("/tickets/3/")
+
+        self.assertEqual(response.json()["purchase_count"], 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self) -> None:
+        user = User.objects.create_user("test", password="test")
+        restaurant = Restaurant.objects.create(owner=user, name="r")
+        Ticket.objects.bulk_create(
+            Ticket(restaurant=restaurant, name=str(n), max_purchase_count=n)
+            for n in range(5)
+        )
+
+    def export(self, params=None, **headers):
+        response = self.client.get("/tickets/export/", params or {}, **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        return b"".join(response.streaming_content)
+
+    def test_export(self):
+        lines = [json.loads(line) for line in self.export().splitlines()]
+
+        self.assertEqual([line["id"] for line in lines], [1, 2, 3, 4, 5])
+        self.assertEqual(
+            {key: value for key, value in lines[2].items() if key != "updated_at"},
+            {
+                "id": 3,
+                "name": "2",
+                "max_purchase_count": 2,
+                "purchase_count": 0,
+                "purchase_left": 2,
+                "restaurant": "r",
+            },
+        )
+
+        compressed = self.export(HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(gzip.decompress(compressed), self.export())
+
+    def test_incremental_export(self):
+        after_id = self.export({"after_id": 3}).splitlines()
+
+        self.assertEqual([json.loads(line)["id"] for line in after_id], [4, 5])
+
+        Ticket.objects.update(updated_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        APIClient().patch("/tickets/2/buy/", {"tickets_to_buy": 1})
+        updated_since = self.export({"updated_since": "2021-01-01T00:00:00"})
+
+        self.assertEqual(
+            [json.loads(line)["id"] for line in updated_since.splitlines()], [2]
+        )
+
+    def test_invalid_parameters(self):
+        for params, detail in (
+            ({"after_id": "a"}, '"after_id" must be a non-negative integer'),
+            ({"after_id": 2 ** 63}, f'"after_id" must be at most {2**63 - 1}'),
+            ({"updated_since": "yesterday"}, '"updated_since" must be an ISO 8601'),
+        ):
+            for accept in ("application/json", "application/x-ndjson"):
+                response = self.client.get(
+                    "/tickets/export/", params, HTTP_ACCEPT=accept
+                )
+
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertEqual(response["Content-Type"], accept)
+                self.assertIn(detail, json.loads(response.content)["detail"])
+
+    def test_accept_encoding(self):
+        plain = self.export()
+
+        for header, compressed in (
+            ("gzip", True),
+            ("GZIP;Q=0.5, br", True),
+            ("*", True),
+            ("gzip;q=0", False),
+            ("gzip;q=0, *", False),
+            ("*;q=0", False),
+            ("gzip;q=0.5, identity", False),
+            ("deflate", False),
+        ):
+            response = self.client.get("/tickets/export/", HTTP_ACCEPT_ENCODING=header)
+            body = b"".join(response.streaming_content)
+
+            self.assertEqual(response.has_header("Content-Encoding"), compressed)
+            self.assertEqual(gzip.decompress(body) if compressed else body, plain)
+
+    @skipUnless(connection.vendor == "sqlite", "Query plans are checked on SQLite")
+    def test_plan(self):
+        # Without statistics on updated_at ranges, SQLite applies both filters
+        # while walking the primary key in id order.
+        for params in ({"after_id": 3}, {"updated_since": "2021-01-01T00:00:00"}):
+            plan = views.export_queryset(params).explain()
+
+            self.assertRegex(plan, r"(SCAN|SEARCH) app_restaurants_ticket\b")
+            self.assertNotIn("USING INDEX", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    @skipUnless(connection.vendor == "postgresql", "PostgreSQL plan")
+    def test_incremental_plan(self):
+        # Reads the few tickets updated since the last export from the index.
+        restaurant = Restaurant.objects.get()
+        Ticket.objects.bulk_create(Ticket(restaurant=restaurant) for _ in range(1000))
+        Ticket.objects.update(updated_at=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        APIClient().patch("/tickets/2/buy/", {"tickets_to_buy": 1})
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE app_restaurants_ticket")
+
+        plan = views.export_queryset({"updated_since": "2021-01-01T00:00:00"}).explain()
+
+        self.assertRegex(plan, r"Index Scan using app_restaurants_ticket_updated_at_")
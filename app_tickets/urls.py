@@ -1,9 +1,17 @@
 from django.urls import path
 
-from .views import PublicTicketList, PublicTicketRetrieve, ticket_buy
+from .views import (
+    PublicTicketList,
+    PublicTicketRetrieve,
+    ticket_batch_buy,
+    ticket_buy,
+    ticket_export,
+)
 
 urlpatterns = [
     path("tickets/", PublicTicketList.as_view()),
     path("tickets/<int:pk>/", PublicTicketRetrieve.as_view()),
     path("tickets/<int:pk>/buy/", ticket_buy),
+    path("tickets/buy/", ticket_batch_buy),
+    path("tickets/export/", ticket_export),
 ]
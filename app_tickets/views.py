@@ -1,47 +1,340 @@
-from time import sleep
+import json
+import zlib
+from datetime import timezone
+from itertools import islice
 
-from django.db import IntegrityError, OperationalError, transaction
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_header_parameters
+from django.utils.timezone import is_naive, make_aware
 from rest_framework import generics
-from rest_framework.decorators import api_view
-from rest_framework.exceptions import ParseError
+from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.exceptions import NotAuthenticated, NotFound, ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
-from app_restaurants.models import Ticket
+from app_restaurants.metrics import register_counters
+from app_restaurants.mixins import ValuesListMixin
+from app_restaurants.models import Ticket, field_maximum
+from app_restaurants.pagination import TicketPagination
 
+from .cache import TicketCache
+from .coalescing import PurchaseCoalescer
+from .filters import (
+    TicketAvailabilityFilter,
+    TicketOrderingFilter,
+    parse_non_negative_int,
+)
+from .idempotency import IdempotencyStore
+from .retry import RetryBudgetExhausted, RetryPolicy, ServiceBusy
 from .serializers import PublicTicketSerializer
 
+purchase_retry = RetryPolicy.from_settings(
+    getattr(settings, "TICKET_PURCHASE_RETRY", {})
+)
 
-class PublicTicketList(generics.ListAPIView):
-    queryset = Ticket.objects.all()
+
+@register_counters
+def purchase_retry_counters():
+    counters = purchase_retry.counters()
+    return {
+        "ticket_purchase_calls_total": (
+            "Purchase database calls made under the retry policy.",
+            counters["calls"],
+        ),
+        "ticket_purchase_retries_total": (
+            "Purchase database calls retried after a transient error.",
+            counters["retries"],
+        ),
+        "ticket_purchase_retries_exhausted_total": (
+            "Purchase database calls that gave up, answered with 503.",
+            counters["exhausted"],
+        ),
+    }
+
+
+ticket_cache = TicketCache(getattr(settings, "TICKET_CACHE_ALIAS", "tickets"))
+
+
+@register_counters
+def ticket_cache_counters():
+    stats = ticket_cache.stats()
+    return {
+        "ticket_cache_hits_total": (
+            "Ticket payloads served from the cache.",
+            stats["hits"],
+        ),
+        "ticket_cache_misses_total": (
+            "Ticket payloads built on a cache miss.",
+            stats["misses"],
+        ),
+        "ticket_cache_evictions_total": (
+            "Entries evicted from the ticket cache, on Redis from the whole server.",
+            stats["evictions"],
+        ),
+    }
+
+
+def settle_purchases(pk, amounts):
+    tickets = purchase_retry.call(Ticket.objects.purchase_many, pk, amounts)
+    if any(tickets):
+        ticket_cache.invalidate_ticket(pk)
+    return tickets
+
+
+purchase_coalescer = PurchaseCoalescer.from_settings(
+    settle_purchases,
+    getattr(settings, "TICKET_PURCHASE_COALESCING", {}),
+    shared_errors=(RetryBudgetExhausted,),
+)
+
+purchase_responses = IdempotencyStore.from_settings(
+    getattr(settings, "TICKET_PURCHASE_IDEMPOTENCY", {})
+)
+
+
+class PublicTicketList(ValuesListMixin, generics.ListAPIView):
+    queryset = Ticket.objects.public()
     serializer_class = PublicTicketSerializer
+    pagination_class = TicketPagination
+    filter_backends = [TicketAvailabilityFilter, TicketOrderingFilter]
+    ordering_fields = ["id", "purchase_left"]
+    ordering = ["id"]
+    list_fields = {
+        "id": "id",
+        "name": "name",
+        "max_purchase_count": "max_purchase_count",
+        "purchase_count": "purchase_count",
+        "purchase_left": "purchase_left",
+        "restaurant": "restaurant__name",
+    }
+
+    def list(self, request, *args, **kwargs):
+        data = ticket_cache.fetch_list(
+            request.build_absolute_uri(),
+            lambda: super(PublicTicketList, self).list(request, *args, **kwargs).data,
+        )
+        return Response(data)
 
 
 class PublicTicketRetrieve(generics.RetrieveAPIView):
     serializer_class = PublicTicketSerializer
 
     def get_queryset(self):
-        return Ticket.objects.filter(pk=self.kwargs["pk"])
+        return Ticket.objects.public().filter(pk=self.kwargs["pk"])
+
+    def retrieve(self, request, *args, **kwargs):
+        data = ticket_cache.fetch_ticket(
+            self.kwargs["pk"],
+            lambda: super(PublicTicketRetrieve, self)
+            .retrieve(request, *args, **kwargs)
+            .data,
+        )
+        return Response(data)
 
 
 def process_purchase(pk, buy_amount):
     try:
         if type(buy_amount) != int:
             raise TypeError
-        with transaction.atomic():
-            ticket = Ticket.objects.get(pk=pk)
-            ticket.purchase_count += buy_amount
-            ticket.save()
+        # Out of the column's range, the amount can't be bought, and it would
+        # fail the whole batch it is coalesced with.
+        if abs(buy_amount) > field_maximum(Ticket.objects.all(), "purchase_count"):
+            raise OverflowError
+        if purchase_coalescer is not None:
+            ticket = purchase_coalescer.submit(pk, buy_amount)
+        else:
+            ticket = purchase_retry.call(Ticket.objects.purchase, pk, buy_amount)
+        # The rejection is told apart from a missing ticket while purchases
+        # still hold the database, so this read is retried as well.
+        exists = ticket is not None or purchase_retry.call(
+            Ticket.objects.filter(pk=pk).exists
+        )
+    except (IntegrityError, OverflowError, TypeError):
+        raise ParseError
+    except RetryBudgetExhausted:
+        raise ServiceBusy(wait=purchase_retry.retry_after)
+
+    if not exists:
+        raise NotFound
+    if ticket is None:
+        raise ParseError
+
+    if purchase_coalescer is None:
+        ticket_cache.invalidate_ticket(pk)
+    return Response(PublicTicketSerializer(ticket).data)
+
+
+def parse_batch_purchase(items):
+    if type(items) != list or not items:
+        raise ParseError
 
-            return Response(PublicTicketSerializer(ticket).data)
-    except (IntegrityError, TypeError):
+    amounts = {}
+    for item in items:
+        if type(item) != dict:
+            raise ParseError
+        ticket_id = item.get("ticket_id")
+        buy_amount = item.get("tickets_to_buy")
+        if type(ticket_id) != int or type(buy_amount) != int:
+            raise ParseError
+        amounts[ticket_id] = amounts.get(ticket_id, 0) + buy_amount
+
+    return sorted(amounts.items())
+
+
+def purchase_all(amounts):
+    with transaction.atomic():
+        tickets = Ticket.objects.purchase_batch(amounts)
+        if tickets[-1] is None:
+            pk, buy_amount = amounts[len(tickets) - 1]
+            if not Ticket.objects.filter(pk=pk).exists():
+                raise NotFound(f"Ticket {pk} not found.")
+            raise ParseError(f"Cannot buy {buy_amount} of ticket {pk}.")
+        ticket_cache.invalidate_tickets(pk for pk, _ in amounts)
+        return tickets
+
+
+def process_batch_purchase(items):
+    amounts = parse_batch_purchase(items)
+    try:
+        tickets = purchase_retry.call(purchase_all, amounts)
+    except (IntegrityError, OverflowError):
         raise ParseError
-    except OperationalError:
-        sleep(0.1)
-        return process_purchase(pk, buy_amount)
+    except RetryBudgetExhausted:
+        raise ServiceBusy(wait=purchase_retry.retry_after)
+
+    return Response(PublicTicketSerializer(tickets, many=True).data)
+
+
+def idempotent(request, func, *args):
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return func(*args)
+
+    # Keys are only unique for one client and endpoint. Anonymous clients
+    # cannot be told apart, e.g. behind a NAT they share an address.
+    if not request.user.is_authenticated:
+        raise NotAuthenticated("Idempotency-Key requires authentication.")
+    scoped_key = f"user:{request.user.pk}:{request.resolver_match.view_name}:{key}"
+
+    fingerprint = (request.path, json.dumps(request.data, sort_keys=True, default=str))
+    return purchase_responses.run(scoped_key, fingerprint, lambda: func(*args))
 
 
 @api_view(["PATCH"])
 def ticket_buy(request, pk):
     buy_amount = request.data.get("tickets_to_buy")
 
-    return process_purchase(pk, buy_amount)
+    return idempotent(request, process_purchase, pk, buy_amount)
+
+
+@api_view(["PATCH"])
+def ticket_batch_buy(request):
+    return idempotent(request, process_batch_purchase, request.data)
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def export_lines(queryset, fields):
+    rows = queryset.values(*fields.values()).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    while True:
+        chunk = list(islice(rows, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield "".join(
+            json.dumps(
+                {name: row[source] for name, source in fields.items()},
+                ensure_ascii=False,
+                separators=(",", ":"),
+                default=export_value,
+            )
+            + "\n"
+            for row in chunk
+        ).encode("utf-8")
+
+
+def export_value(value):
+    value = value.astimezone(timezone.utc).isoformat()
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+
+def gzip_lines(lines):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepts_gzip(header):
+    """
+    Whether an Accept-Encoding header accepts gzip, directly or through "*",
+    with a q-value above 0 and not below the one of an explicit identity.
+    """
+    qvalues = {}
+    for coding in header.split(","):
+        coding, params = parse_header_parameters(coding)
+        if coding:
+            try:
+                qvalues[coding] = float(params.get("q", 1))
+            except ValueError:
+                qvalues[coding] = 0
+    gzip = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0)))
+    return gzip > 0 and gzip >= qvalues.get("identity", 0)
+
+
+def export_queryset(params):
+    queryset = Ticket.objects.with_purchase_left().order_by("id")
+
+    after_id = params.get("after_id")
+    if after_id is not None:
+        queryset = queryset.filter(
+            id__gt=parse_non_negative_int(
+                after_id, "after_id", field_maximum(queryset, "id")
+            )
+        )
+
+    updated_since = params.get("updated_since")
+    if updated_since is not None:
+        try:
+            updated_since = parse_datetime(updated_since)
+        except ValueError:
+            updated_since = None
+        if updated_since is None:
+            raise ParseError('"updated_since" must be an ISO 8601 datetime')
+        if is_naive(updated_since):
+            updated_since = make_aware(updated_since, timezone.utc)
+        queryset = queryset.filter(updated_at__gte=updated_since)
+
+    return queryset
+
+
+class JSONLinesRenderer(JSONRenderer):
+    """Errors of the export, as a single JSON line."""
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+
+@api_view(["GET"])
+@renderer_classes([JSONRenderer, JSONLinesRenderer])
+def ticket_export(request, stream=iter):
+    # The async view streams the lines with another `stream`.
+    fields = dict(PublicTicketList.list_fields, updated_at="updated_at")
+    lines = export_lines(export_queryset(request.query_params), fields)
+
+    if accepts_gzip(request.headers.get("Accept-Encoding", "")):
+        response = StreamingHttpResponse(
+            stream(gzip_lines(lines)), content_type="application/x-ndjson"
+        )
+        response["Content-Encoding"] = "gzip"
+    else:
+        response = StreamingHttpResponse(
+            stream(lines), content_type="application/x-ndjson"
+        )
+    response["Vary"] = "Accept-Encoding"
+    return response
@@ -2,6 +2,12 @@
 ASGI config for restaurants_test project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests are routed with restaurants_test.asgi_urls, which serves async-native
+variants of some views.
+
+Serve it with an ASGI server, e.g.:
+
+    uvicorn restaurants_test.asgi:application --workers 4
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -9,8 +15,21 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'restaurants_test.settings')
 
-application = get_asgi_application()
+
+class RestaurantsASGIHandler(ASGIHandler):
+    urlconf = "restaurants_test.asgi_urls"
+
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = self.urlconf
+        return request, error_response
+
+
+django.setup(set_prefix=False)
+application = RestaurantsASGIHandler()
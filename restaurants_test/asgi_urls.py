@@ -0,0 +1,19 @@
+"""restaurants_test ASGI URL Configuration
+
+Same routes as restaurants_test.urls, with async-native views in front of the
+synchronous ones they replace when served through restaurants_test.asgi.
+"""
+from django.urls import path
+
+from app_restaurants import async_views as restaurant_views
+from app_tickets import async_views as ticket_views
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path("signup/", restaurant_views.signup),
+    path("login/", restaurant_views.login),
+    path("tickets/", ticket_views.ticket_list),
+    path("tickets/<int:pk>/", ticket_views.ticket_detail),
+    path("tickets/export/", ticket_views.ticket_export),
+] + sync_urlpatterns
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -44,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "app_restaurants.metrics.RequestMetricsMiddleware",
+    "app_restaurants.profiling.RequestProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -77,14 +81,122 @@ WSGI_APPLICATION = "restaurants_test.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    "default": {
+DATABASE_PROFILES = {
+    "sqlite": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
-    }
+    },
+    "postgresql": {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.environ.get("POSTGRES_DB", "restaurants"),
+        "USER": os.environ.get("POSTGRES_USER", "postgres"),
+        "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+        "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
+        "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
+    },
+}
+
+DATABASES = {
+    "default": DATABASE_PROFILES[os.environ.get("DATABASE_PROFILE", "sqlite")],
+}
+
+# Resets the id sequences of PostgreSQL before each test, see
+# restaurants_test.test_runner
+TEST_RUNNER = "restaurants_test.test_runner.TestRunner"
+
+# PRAGMAs run on every new SQLite connection, see app_restaurants.signals.
+# busy_timeout (ms) stays well below TICKET_PURCHASE_RETRY's DEADLINE, so a
+# locked database is retried with backoff rather than waited out in SQLite.
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 100,
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+# "local" keeps the caches in each process, for a single process such as
+# runserver. Anything serving from more processes needs "redis", where ticket
+# cache invalidations, idempotent replays and token revocations reach every
+# process; `manage.py check --deploy` fails on per-process caches.
+CACHE_PROFILES = {
+    "local": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+        # Public ticket payloads, see app_tickets.cache
+        "tickets": {
+            "BACKEND": "app_tickets.cache.StatsLocMemCache",
+            "LOCATION": "tickets",
+            "TIMEOUT": 60,
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        },
+        # Token -> user lookups, see app_restaurants.authentication. Revocations
+        # that skip the signals are seen after TIMEOUT.
+        "auth_tokens": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "auth_tokens",
+            "TIMEOUT": 10,
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        },
+        # Outcomes of purchases by Idempotency-Key, see app_tickets.idempotency
+        "idempotency": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "idempotency",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        },
+        # Slow request log shared by the processes of one host, see
+        # app_restaurants.profiling
+        "profiling": {
+            "BACKEND": "app_restaurants.profiling.LockingFileBasedCache",
+            "LOCATION": os.path.join(
+                tempfile.gettempdir(), "restaurants_test_profiling"
+            ),
+            "TIMEOUT": None,
+        },
+    },
+    "redis": {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+        },
+        "tickets": {
+            "BACKEND": "app_tickets.cache.StatsRedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            "KEY_PREFIX": "tickets",
+            "TIMEOUT": 60,
+        },
+        "auth_tokens": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            "KEY_PREFIX": "auth_tokens",
+            "TIMEOUT": 10,
+        },
+        "idempotency": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            "KEY_PREFIX": "idempotency",
+        },
+        "profiling": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+            "KEY_PREFIX": "profiling",
+            "TIMEOUT": None,
+        },
+    },
+}
+
+CACHES = CACHE_PROFILES[os.environ.get("CACHE_PROFILE", "local")]
+
+TICKET_CACHE_ALIAS = "tickets"
+
+AUTH_TOKEN_CACHE_ALIAS = "auth_tokens"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -130,10 +242,70 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "app_restaurants.authentication.CachedTokenAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ],
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
     "PAGE_SIZE": 10,
     "TEST_REQUEST_DEFAULT_FORMAT": "json",
 }
+
+# Default pagination of ticket lists, "page" or "cursor" (keyset on id), see
+# app_restaurants.pagination
+TICKET_PAGINATION = "page"
+
+# Retries of ticket purchases that hit a locked database, see app_tickets.retry
+TICKET_PURCHASE_RETRY = {
+    "MAX_ATTEMPTS": 5,
+    "BASE_DELAY": 0.01,
+    "MAX_DELAY": 0.2,
+    "DEADLINE": 1.0,
+    "RETRY_AFTER": 1,
+}
+
+# Group concurrent purchases of the same ticket into one UPDATE, see
+# app_tickets.coalescing
+TICKET_PURCHASE_COALESCING = {
+    "ENABLED": True,
+    "WINDOW": 0.002,
+    "MAX_BATCH_SIZE": 64,
+}
+
+# Replay of purchases sent with an Idempotency-Key header, see
+# app_tickets.idempotency. Keys are scoped by user, so anonymous requests with
+# the header are rejected with 401.
+TICKET_PURCHASE_IDEMPOTENCY = {
+    "CACHE_ALIAS": "idempotency",
+    "TTL": 24 * 60 * 60,
+    "WAIT_TIMEOUT": 5,
+    "LOCK_TIMEOUT": 60,
+}
+
+# Password hashing of the async signup/login views, see app_restaurants.hashing
+PASSWORD_HASHING_POOL = {
+    "MAX_WORKERS": 2,
+    "MAX_QUEUE": 32,
+    "RETRY_AFTER": 1,
+}
+
+# Server-Timing headers and /metrics/ histograms, see app_restaurants.metrics.
+# Both are only for staff users and clients in INTERNAL_NETWORKS (CIDR); behind
+# a proxy REMOTE_ADDR is the proxy's, so leave out the proxy's network.
+REQUEST_METRICS = {
+    "ENABLED": True,
+    "SERVER_TIMING": True,
+    "INTERNAL_NETWORKS": [],
+}
+
+# Profiling of requests sent with an X-Profile-Token header (see
+# `manage.py slow_requests --token`) or sampled, and the slow request log, see
+# app_restaurants.profiling
+REQUEST_PROFILING = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0,
+    "TOKEN_MAX_AGE": 60 * 60,
+    "TOP_FUNCTIONS": 20,
+    "SLOW_REQUEST_THRESHOLD": 0.5,
+    "SLOW_REQUEST_LOG_SIZE": 100,
+    "CACHE_ALIAS": "profiling",
+}
@@ -0,0 +1,42 @@
+"""
+Test runner of the project, see settings.TEST_RUNNER.
+"""
+from unittest import TextTestResult
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+def reset_sequences():
+    """Point the id sequences of PostgreSQL databases after their last row."""
+    for connection in connections.all():
+        if connection.vendor != "postgresql":
+            continue
+        statements = connection.ops.sequence_reset_sql(no_style(), apps.get_models())
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+class ResetSequencesResult:
+    def startTest(self, test):
+        reset_sequences()
+        super().startTest(test)
+
+
+class TestRunner(DiscoverRunner):
+    """
+    DiscoverRunner that resets the id sequences of PostgreSQL before each
+    test.
+
+    The tests refer to rows by the ids SQLite gives them, where the ids of
+    rows a TestCase rolled back are used again. PostgreSQL sequences are not
+    rolled back, so without the reset ids would depend on the tests run
+    before.
+    """
+
+    def get_resultclass(self):
+        resultclass = super().get_resultclass() or TextTestResult
+        return type("ResetSequencesResult", (ResetSequencesResult, resultclass), {})